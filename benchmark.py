@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+
+"""
+benchmark - Reproducible performance measurements of the daemon.
+The real scheduler, DB and display threads run against stub
+hardware: the simulated GPIO backend records the time of every
+relay edge, and the OLED wrapper pushes its frames to an I2C stub.
+Everything runs in a temporary directory with its own DB.
+
+Measured:
+- render: time per frame and frames per second of each screen
+- renderCheck: bytes of each screen frame that differ from
+  the same frame drawn by PIL, with realistic screen strings
+- dbPoll: DbHandler check cycle, with and without changes
+- propagation: post_channel request to scheduler status update
+- actuation: relay edge time against the scheduled time
+- idle: CPU time, thread wakeups, threads and resident memory
+  with nothing scheduled
+
+Stop the gardenpi service first, the benchmark uses the same
+change notification socket.
+
+Usage: benchmark.py [--output results.json] [--baseline old.json]
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+import clock
+import gpios
+import oled
+import control
+import queueCmd
+import schedule
+import gardenpi
+import simulation
+import storage
+import render
+from PIL import Image
+from PIL import ImageDraw
+
+ACTUATION_PERIOD_S = 8
+ACTUATION_DURATION_S = 3
+
+
+class StubI2c():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    I2C device stub counting the bytes written
+    """
+    def __init__(self):
+        self.bytesWritten = 0
+    def writeList(self, register, data):
+        # pylint: disable="unused-argument"
+        self.bytesWritten += len(data)
+
+
+class StubSsd1306():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Adafruit SSD1306 stub on an I2C stub
+    """
+    def __init__(self, width=128, height=64):
+        self.width = width
+        self.height = height
+        self._i2c = StubI2c()
+    def begin(self):
+        pass
+
+
+class StatusTap():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Wraps the display thread queue to timestamp the channel
+    status updates sent by the scheduler
+    """
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.updates = []
+        self.put = self.tap
+    def tap(self, cmd, *args, **kwargs):
+        if cmd.getType() == queueCmd.CMD_CHANNEL_CFG:
+            self.updates.append((time.perf_counter(), cmd.getChannel(), cmd.getDuration()))
+        return self.mailbox.put(cmd, *args, **kwargs)
+    def __getattr__(self, name):
+        return getattr(self.mailbox, name)
+
+
+class StubFlowMeter():
+    # pylint: disable="invalid-name"
+    """
+    Flow meter stub with a channel running
+    """
+    def rate(self):
+        return 12.5
+    def volumes(self):
+        return {3: 41.2}, {}, [3]
+
+
+class PilRenderer():
+    # pylint: disable="invalid-name"
+    """
+    Reference renderer drawing every frame with PIL, as the
+    screens did before the frames were composed from cached lines
+    """
+    def __init__(self, font, width, height):
+        self.font = font
+        self.width = width
+        self.frame = Image.new('1', (width, height))
+        self.draw = ImageDraw.Draw(self.frame)
+    def begin(self):
+        self.draw.rectangle((0, 0, self.width, self.frame.height), outline=0, fill=0)
+    def text(self, x, y, text, inverted=False):
+        if inverted:
+            self.draw.rectangle((0, y, self.width, y + render.LINE_CELL - 1), outline=0, fill=255)
+            self.draw.text((x, y), text, font=self.font, fill=0)
+        else:
+            self.draw.text((x, y), text, font=self.font, fill=255)
+    def hline(self, y):
+        self.draw.line([(0, y), (self.width, y)], fill=255)
+    def image(self):
+        return self.frame
+
+
+class RendererTee():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Sends the drawing calls of the screens to the renderer
+    and to the PIL reference renderer
+    """
+    def __init__(self, renderer, reference):
+        self.renderer = renderer
+        self.reference = reference
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            getattr(self.reference, name)(*args, **kwargs)
+            return getattr(self.renderer, name)(*args, **kwargs)
+        return call
+
+
+def percentiles(samples, scale=1000):
+    """
+    Return the distribution of samples, scaled to ms by default
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * scale
+    return {"count": len(ordered),
+            "min": ordered[0] * scale,
+            "p50": rank(0.5),
+            "p90": rank(0.9),
+            "p99": rank(0.99),
+            "max": ordered[-1] * scale}
+
+
+def wakeups():
+    """
+    Return the context switches of all the threads of the process
+    """
+    total = 0
+    for statusName in glob.glob("/proc/self/task/*/status"):
+        try:
+            with open(statusName, encoding="ascii") as status:
+                for line in status:
+                    if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def processStatus(name):
+    # pylint: disable="invalid-name"
+    """
+    Return a numeric field of /proc/self/status
+    """
+    with open("/proc/self/status", encoding="ascii") as status:
+        for line in status:
+            if line.startswith(name + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def channelConfig(channel, enabled, period, duration, start):
+    # pylint: disable="invalid-name"
+    """
+    Return a channel configuration command
+    """
+    cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+    cmd.setConfig(channel, enabled, period, duration, start)
+    cmd.setSchedule([], schedule.ALL_DAYS)
+    return cmd
+
+
+def benchRender(frames):
+    # pylint: disable="invalid-name"
+    """
+    Time each screen, moving the highlighted line every frame
+    so each frame differs from the previous one
+    """
+    disp = oled.OledDisplay(StubSsd1306())
+    handler = control.DisplayHandler(disp)
+    handler.disp.begin()
+    for channel in range(1, 9):
+        cmd = channelConfig(channel, 1, 86400, 600, 21600 + channel * 600)
+        cmd.addStatus(queueCmd.CHANNEL_WAITING, clock.now() + channel * 600)
+        handler.chConfigs[channel] = cmd
+    handler.selChannel = 1
+    screens = {"status": (handler.statusScreen, 1),
+               "channelSel": (handler.channelSelScreen, 8),
+               "channelStatus": (handler.channelStatusScreen, 5)}
+    res = {}
+    for name, (render, lines) in screens.items():
+        bytesBefore = disp.disp._i2c.bytesWritten # pylint: disable="protected-access"
+        samples = []
+        for frame in range(frames):
+            handler.currentLine = frame % lines + 1
+            handler.startLine = max(1, handler.currentLine - 4)
+            start = time.perf_counter()
+            render()
+            samples.append(time.perf_counter() - start)
+        res[name] = {"frameMs": percentiles(samples),
+                     "framesPerSecond": len(samples) / sum(samples),
+                     "i2cBytesPerFrame": (disp.disp._i2c.bytesWritten - bytesBefore) / frames} # pylint: disable="protected-access"
+    return res
+
+
+def checkRender():
+    # pylint: disable="invalid-name"
+    """
+    Compare the frames of every screen with the same frames
+    drawn by PIL, returning the bytes that differ per screen
+    """
+    disp = oled.OledDisplay(StubSsd1306())
+    handler = control.DisplayHandler(disp)
+    handler.disp.begin()
+    reference = PilRenderer(handler.font, disp.width, disp.height)
+    handler.renderer = RendererTee(handler.renderer, reference)
+    handler.stats.values = {"ip": "IP: 192.168.100.254 10.0.0.2",
+                            "ssid": "SSID: MyHomeNetwork",
+                            "signal": "Signal: -61 dBm 70%"}
+    handler.setFlowMeter(StubFlowMeter())
+    for channel in range(1, 9):
+        cmd = channelConfig(channel, channel % 3 != 0, 86400, 600, 21600 + channel * 600)
+        cmd.addStatus(queueCmd.CHANNEL_WAITING if channel % 2 else queueCmd.CHANNEL_ON,
+                      clock.now() + channel * 600)
+        handler.chConfigs[channel] = cmd
+    frames = [("bootWaiting", handler.bootScreen)]
+    def bootReady():
+        handler.networkUp = True
+        handler.timeValid = True
+        handler.bootScreen()
+    frames.append(("bootReady", bootReady))
+    frames.append(("status", handler.statusScreen))
+    for line in range(1, 9):
+        def channelSel(line=line):
+            handler.currentLine = line
+            handler.startLine = max(1, line - 4)
+            handler.channelSelScreen()
+        frames.append((f"channelSel{line}", channelSel))
+    for channel in range(1, 9):
+        def channelStatus(channel=channel):
+            handler.selChannel = channel
+            handler.currentLine = 1
+            handler.channelStatusScreen()
+        frames.append((f"channelStatus{channel}", channelStatus))
+    res = {}
+    for name, draw in frames:
+        draw()
+        frame = handler.renderer.renderer.image().tobytes()
+        expected = reference.image().tobytes()
+        res[name] = {"mismatchedBytes": sum(a != b for a, b in zip(frame, expected))}
+        if res[name]["mismatchedBytes"]:
+            logging.warning("Frame %s differs from PIL in %d bytes", name, res[name]["mismatchedBytes"])
+    return res
+
+
+def benchDbPoll(cycles):
+    # pylint: disable="invalid-name"
+    """
+    Time the DB check cycle when nothing changed, and when
+    every channel was updated by another connection
+    """
+    scheduler = gardenpi.SchedulerHandler(range(1, 9), None)
+    handler = gardenpi.DbHandler(scheduler)
+    handler.listener.close()
+    con = storage.connect()
+    writer = storage.connect()
+    handler.checkChanges(con, True)
+    idle = []
+    changed = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        handler.checkChanges(con, False)
+        idle.append(time.perf_counter() - start)
+        writer.execute("UPDATE configuration set updated=1")
+        start = time.perf_counter()
+        handler.checkChanges(con, False)
+        changed.append(time.perf_counter() - start)
+        while not scheduler.getQueue().empty():
+            scheduler.getQueue().get(block=False)
+    writer.close()
+    con.close()
+    return {"unchangedMs": percentiles(idle), "changedMs": percentiles(changed)}
+
+
+def benchPropagation(tap, requests):
+    # pylint: disable="invalid-name,import-outside-toplevel"
+    """
+    Time from a post_channel request to the scheduler sending
+    the new channel status, through the DB and notify socket
+    """
+    import gardenPiServer
+    client = gardenPiServer.app.test_client()
+    samples = []
+    for index in range(requests):
+        duration = 60 + index
+        del tap.updates[:]
+        start = time.perf_counter()
+        response = client.post("/channel/1", json={"enabled": 0, "period": 86400,
+                                        "duration": duration, "start": 21600})
+        while not any(update[2] == duration for update in tap.updates):
+            if time.perf_counter() - start > 2 * gardenpi.DB_POLL_FALLBACK_S:
+                logging.warning("Configuration change %d not propagated, status %d", index, response.status_code)
+                break
+            time.sleep(0.0005)
+        else:
+            arrival = next(update[0] for update in tap.updates if update[2] == duration)
+            samples.append(arrival - start)
+    return {"latencyMs": percentiles(samples)}
+
+
+def benchActuation(scheduler, backend, seconds):
+    # pylint: disable="invalid-name"
+    """
+    Run every channel on a short period and compare each relay
+    edge with the time it was scheduled for
+    """
+    del backend.edges[:]
+    for channel in range(1, 9):
+        scheduler.getQueue().put(channelConfig(channel, 1, ACTUATION_PERIOD_S,
+                                               ACTUATION_DURATION_S, channel))
+    time.sleep(seconds)
+    schedules = {}
+    for channel in range(1, 9):
+        schedules[gpios.relayGpios[channel - 1]] = scheduler.getChannel(channel).schedule
+    # Channels still on are turned off by the new configuration,
+    # those edges weren't scheduled
+    endTime = clock.now()
+    for channel in range(1, 9):
+        scheduler.getQueue().put(channelConfig(channel, 0, 0, 0, 0))
+    time.sleep(0.5)
+    onLatency = []
+    offLatency = []
+    for edgeTime, pin, value in list(backend.edges):
+        if pin not in gpios.relayGpios or edgeTime >= endTime:
+            continue
+        runs = schedules[pin]
+        if not value:
+            scheduled = runs.nextStart(edgeTime - ACTUATION_PERIOD_S / 2)
+            onLatency.append(edgeTime - scheduled)
+        else:
+            scheduled = runs.nextStart(edgeTime - ACTUATION_DURATION_S - ACTUATION_PERIOD_S / 2)
+            offLatency.append(edgeTime - scheduled - ACTUATION_DURATION_S)
+    return {"onMs": percentiles(onLatency), "offMs": percentiles(offLatency)}
+
+
+def benchIdle(display, seconds):
+    # pylint: disable="invalid-name"
+    """
+    Measure CPU time, wakeups and frames sent with all channels
+    disabled and the status screen shown
+    """
+    cpuStart = time.process_time()
+    wakeStart = wakeups()
+    framesStart = display.framesSent
+    time.sleep(seconds)
+    cpu = time.process_time() - cpuStart
+    woken = wakeups() - wakeStart
+    return {"cpuSecondsPerHour": cpu * 3600 / seconds,
+            "wakeupsPerSecond": woken / seconds,
+            "framesPerSecond": (display.framesSent - framesStart) / seconds,
+            "threads": threading.active_count(),
+            "residentKb": processStatus("VmRSS")}
+
+
+def runBenchmarks(args):
+    # pylint: disable="invalid-name"
+    """
+    Run all the benchmarks in the current directory
+    """
+    gardenpi.db_init()
+    backend = simulation.SimGpioBackend(clock)
+    gpios.setBackend(backend)
+    gpios.gpio_init()
+
+    res = {"render": benchRender(args.frames), "renderCheck": checkRender(),
+           "dbPoll": benchDbPoll(args.cycles)}
+
+    ctrlThread = control.DisplayHandler(oled.OledDisplay(StubSsd1306()))
+    ctrlThread.q = StatusTap(ctrlThread.q)
+    schedThread = gardenpi.SchedulerHandler(range(1, 9), ctrlThread, 0, 0)
+    dbThread = gardenpi.DbHandler(schedThread)
+    threads = [ctrlThread, schedThread, dbThread]
+    for thread in threads:
+        thread.start()
+    ctrlThread.bootDone()
+    try:
+        res["propagation"] = benchPropagation(ctrlThread.q, args.requests)
+        res["actuation"] = benchActuation(schedThread, backend, args.actuation_seconds)
+        res["idle"] = benchIdle(ctrlThread.disp, args.idle_seconds)
+    finally:
+        schedThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        ctrlThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        dbThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        dbThread.wake()
+        for thread in threads:
+            thread.join()
+    return res
+
+
+def flatten(values, prefix=""):
+    """
+    Return nested results as a flat dict of dotted names
+    """
+    res = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            res.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            res[prefix + key] = value
+    return res
+
+
+def compare(baseline, results):
+    """
+    Print the change of every metric against a baseline run
+    """
+    old = flatten(baseline["results"])
+    new = flatten(results["results"])
+    for name in sorted(new):
+        if name not in old:
+            continue
+        change = (new[name] - old[name]) / old[name] * 100 if old[name] else 0
+        print(f"{name:45} {old[name]:12.3f} {new[name]:12.3f} {change:+8.1f}%")
+
+
+def main():
+    # pylint: disable="invalid-name"
+    """
+    Parse the arguments, run and save the results
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the gardenpi daemon on stub hardware")
+    parser.add_argument("--output", help="JSON results file, stdout if not given")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--label", default="", help="Free text stored with the results")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--cycles", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--actuation-seconds", type=float, default=60)
+    parser.add_argument("--idle-seconds", type=float, default=60)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+
+    workDir = tempfile.mkdtemp(prefix="gardenpi-bench-")
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    try:
+        results = {"label": args.label,
+                   "timestamp": time.time(),
+                   "python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "results": runBenchmarks(args)}
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline:
+            compare(json.load(baseline), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+clock - Wall clock handling for a system that may start
+before its time is synchronized.
+Until the time is synchronized the wall clock is estimated
+from the monotonic clock, anchored at the system time or at
+the last time known to be good, whichever is later. When the
+synchronization arrives the difference with the estimate is
+returned, so schedules can be re-anchored.
+Readiness of the network and of the time synchronization is
+read directly from the kernel and systemd state files.
+"""
+import os
+import time
+import ctypes
+import logging
+import threading
+
+LAST_TIME_FILE = "gardenpi.clock"
+TIMESYNC_FLAG = "/run/systemd/timesync/synchronized"
+
+# struct timex from linux/timex.h, only the fields up to status are used
+STA_UNSYNC = 0x0040
+
+
+class _Timex(ctypes.Structure):
+    # pylint: disable="too-few-public-methods"
+    _fields_ = [("modes", ctypes.c_uint),
+                ("offset", ctypes.c_long),
+                ("freq", ctypes.c_long),
+                ("maxerror", ctypes.c_long),
+                ("esterror", ctypes.c_long),
+                ("status", ctypes.c_int),
+                ("padding", ctypes.c_byte * 256)]
+
+
+_lock = threading.Lock()
+_timeSource = None
+_synchronized = False
+_anchorWall = time.time()
+_anchorMono = time.monotonic()
+
+
+def init():
+    # pylint: disable="invalid-name,global-statement"
+    """
+    Anchor the estimated wall clock. If the system time is
+    behind the last time saved, the saved time is used instead.
+    """
+    global _anchorWall, _anchorMono
+    lastKnown = 0
+    try:
+        with open(LAST_TIME_FILE, encoding="ascii") as lastFile:
+            lastKnown = float(lastFile.read().strip())
+    except (OSError, ValueError):
+        pass
+    with _lock:
+        _anchorMono = time.monotonic()
+        _anchorWall = max(time.time(), lastKnown)
+    if lastKnown > time.time():
+        logging.warning("System time is behind the last known time, using %s",
+                        time.ctime(lastKnown))
+
+
+def setTimeSource(source):
+    # pylint: disable="invalid-name,global-statement"
+    """
+    Replace the wall clock with a function returning the
+    current time, used to run against a virtual clock.
+    None restores the system clock.
+    """
+    global _timeSource
+    _timeSource = source
+
+
+def now():
+    # pylint: disable="invalid-name"
+    """
+    Return the current wall clock time
+    """
+    if _timeSource is not None:
+        return _timeSource()
+    if _synchronized:
+        return time.time()
+    with _lock:
+        return _anchorWall + (time.monotonic() - _anchorMono)
+
+
+def isSynchronized():
+    # pylint: disable="invalid-name"
+    """
+    Return True once setSynchronized() has been called
+    """
+    return _synchronized
+
+
+def setSynchronized():
+    # pylint: disable="invalid-name,global-statement"
+    """
+    Switch to the system time once it is synchronized.
+    Returns the difference between the system time and the
+    estimate that was in use.
+    """
+    global _synchronized
+    with _lock:
+        if _synchronized:
+            return 0
+        delta = time.time() - (_anchorWall + (time.monotonic() - _anchorMono))
+        _synchronized = True
+    return delta
+
+
+def saveLastKnown():
+    # pylint: disable="invalid-name"
+    """
+    Save the current time as the last known good time.
+    Only done once the time is synchronized.
+    """
+    if not _synchronized:
+        return
+    tmpName = LAST_TIME_FILE + ".tmp"
+    with open(tmpName, "w", encoding="ascii") as lastFile:
+        lastFile.write(f"{time.time():.0f}\n")
+    os.replace(tmpName, LAST_TIME_FILE)
+
+
+def timeSyncReady():
+    # pylint: disable="invalid-name"
+    """
+    Return True if the system time is synchronized. Checks the
+    flag file of systemd-timesyncd, then the kernel NTP status
+    so other NTP daemons are detected too.
+    """
+    if os.path.exists(TIMESYNC_FLAG):
+        return True
+    timex = _Timex()
+    # The symbols of the running process include libc
+    if ctypes.CDLL(None).adjtimex(ctypes.byref(timex)) < 0:
+        return False
+    return (timex.status & STA_UNSYNC) == 0
+
+
+def networkReady():
+    # pylint: disable="invalid-name"
+    """
+    Return True if there is a default route
+    """
+    try:
+        with open("/proc/net/route", encoding="ascii") as routes:
+            next(routes)
+            for line in routes:
+                fields = line.split()
+                if len(fields) > 3 and fields[1] == "00000000" and int(fields[3], 16) & 1:
+                    return True
+    except OSError:
+        pass
+    return False
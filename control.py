@@ -6,14 +6,16 @@ import time
 import math
 import logging
 import threading
-import subprocess
 import queue
-from PIL import Image
-from PIL import ImageDraw
 from PIL import ImageFont
-import Adafruit_SSD1306
 import gpios
 import queueCmd
+import schedule
+import sysstats
+import oled
+import clock
+import render
+import metrics
 
 
 
@@ -21,6 +23,12 @@ STATE_CLEAR_SCREEN = 0
 STATE_SHOW_STATUS = 1
 STATE_CHANNEL_SEL = 2
 STATE_CHANNEL_STATUS = 3
+STATE_BOOT = 4
+
+frameTime = metrics.histogram("gardenpi_display_frame_seconds",
+                              "Time to render a screen and send it to the display")
+pushTime = metrics.histogram("gardenpi_display_push_seconds",
+                             "Time to send a frame to the display")
 
 def durationString(duration):
     # pylint: disable="invalid-name"
@@ -42,9 +50,7 @@ def startTimeString(timestamp):
     Convert a Unix timestamp date into a time of day string
     for display in HH:MM:SS format. 
     """
-    currentTime = time.time()
-    gmt = time.localtime(currentTime)
-    startOfDay = math.trunc(currentTime - ((gmt.tm_hour * 3600 )+(gmt.tm_min*60)+gmt.tm_sec))
+    startOfDay = schedule.startOfDay(clock.now())
     if timestamp > startOfDay:
         duration = timestamp - startOfDay
     else:
@@ -56,13 +62,20 @@ class DisplayHandler(threading.Thread):
     """
     Thread that monitors the GPIOs connected to the front panel buttons
     and controls the SSD1306 OLED display.
+    Another display object with the same interface can be passed
+    in disp, for example the simulated one in simulation.py.
     """
-    def __init__(self, *args, **kwargs):
-        self.q = queue.Queue(maxsize=20)
+    def __init__(self, disp=None, channelCount=8, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.q = queueCmd.Mailbox(queueCmd.MAILBOX_SIZE + channelCount)
         # 128x64 display with hardware I2C:
         # Note you can change the I2C address by passing an i2c_address parameter like:
         # disp = Adafruit_SSD1306.SSD1306_128_64(rst=RST, i2c_address=0x3C)
-        self.disp = Adafruit_SSD1306.SSD1306_128_64(rst=None)
+        # The OledDisplay wrapper only sends the parts of each frame that changed
+        if disp is None:
+            import Adafruit_SSD1306 # pylint: disable="import-outside-toplevel"
+            disp = oled.OledDisplay(Adafruit_SSD1306.SSD1306_128_64(rst=None))
+        self.disp = disp
         # Load default font.
         # Alternatively load a TTF font.
         # Make sure the .ttf font file is in the same directory as the python script!
@@ -70,47 +83,83 @@ class DisplayHandler(threading.Thread):
         # font = ImageFont.truetype('Minecraftia.ttf', 8)
         # Draw a black filled box to clear the image.
         self.font = ImageFont.load_default()
+        # Glyphs are rasterized once, frames are composed from cached lines
+        self.renderer = render.TextRenderer(self.font, self.disp.width, self.disp.height)
         self.startLine = 0
         self.currentLine = 0
-        self.state = STATE_CLEAR_SCREEN
+        self.state = STATE_BOOT
         self.endscreen = 0
         self.selChannel = 0
+        self.networkUp = False
+        self.timeValid = False
+        self.dirty = False
+        self.stats = sysstats.StatsProvider()
+        self.stats.daemon = True
+        self.flowMeter = None
 
-        self.chConfigs = []
-        for ch in range(1,9):
-            config = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
-            config.setConfig(ch,0,0,0,0)
-            config.addStatus(queueCmd.CHANNEL_OFF,0)
-            self.chConfigs.insert(ch-1,config)
+        # Last configuration received per channel. Channels not
+        # configured yet are shown as disabled
+        self.channelCount = channelCount
+        self.chConfigs = {}
         super().__init__(*args, **kwargs)
     def getQueue(self):
         """
         Return thread queue
         """
         return self.q
+    def channelConfig(self, channel):
+        """
+        Return the last configuration of a channel
+        """
+        config = self.chConfigs.get(channel)
+        if config is None:
+            config = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+            config.setConfig(channel,0,0,0,0)
+        return config
+    def setFlowMeter(self, flowMeter):
+        """
+        Show the flow and run volumes of a flow meter
+        on the status screen
+        """
+        self.flowMeter = flowMeter
+    def pushFrame(self):
+        """
+        Send the frame composed by the renderer to the display
+        """
+        startTime = time.perf_counter()
+        self.disp.image(self.renderer.image())
+        self.disp.display()
+        pushTime.observe(time.perf_counter() - startTime)
     def clearScreen(self):
         """
         Function to clear the OLED display.
         """
         self.disp.clear()
         self.disp.display()
+    def setBootStatus(self, networkUp, timeValid):
+        """
+        Update the network and time sync status shown
+        on the boot screen.
+        WARNING: Called from the main thread
+        """
+        if (networkUp, timeValid) != (self.networkUp, self.timeValid):
+            self.networkUp = networkUp
+            self.timeValid = timeValid
+            self.q.put(queueCmd.QueueCommand(queueCmd.CMD_WAKE_UP))
+
+    def bootDone(self):
+        """
+        Leave the boot screen and show the status screen.
+        WARNING: Called from the main thread
+        """
+        self.q.put(queueCmd.QueueCommand(queueCmd.CMD_BOOT_DONE))
+
     def bootScreen(self):
         """
-        Function to render the boot screen.
-        This function queries systemd for the status
-        of network and time sync, and returns True
-        only if both are correct. It will display
-        a boot screen showing the status of both
-        """
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        width = self.disp.width
-        height = self.disp.height
-        image = Image.new('1', (width, height))
-        # Get drawing object to draw on image.
-        draw = ImageDraw.Draw(image)
-        # Draw a black filled box to clear the image.
-        draw.rectangle((0,0,width,height), outline=0, fill=0)
+        Function to render the boot screen, showing the
+        status of network and time sync. Channels are
+        already being scheduled while it is shown.
+        """
         # First define some constants to allow easy resizing of shapes.
         padding = -2
         top = padding
@@ -118,43 +167,19 @@ class DisplayHandler(threading.Thread):
         # Move left to right keeping track of the current x position for drawing shapes.
         x = 0
 
-        ready = False
-        res = subprocess.check_output("./stats.sh check-network", shell = True )
-        res = str(res.decode('utf-8')).strip()
-        if res == "active":
-            networkStatus = "Network is up"
-            res = subprocess.check_output("./stats.sh check-time", shell = True )
-            res = str(res.decode('utf-8')).strip()
-            if res == "active":
-                timeSync = "Date/Time is valid"
-                ready = True
-            else:
-                timeSync = "Waiting for time sync..."
-        else:
-            networkStatus = "Waiting for network..."
-            timeSync = ""
-        draw.text((x, top),       str("Started gardenpi"), font=self.font, fill=255)
-        draw.text((x, top+10),    " ", font=self.font, fill=255)
-        draw.text((x, top+20),    networkStatus, font=self.font, fill=255)
-        draw.text((x, top+30),    timeSync, font=self.font, fill=255)
+        networkStatus = "Network is up" if self.networkUp else "Waiting for network..."
+        timeSync = "Date/Time is valid" if self.timeValid else "Waiting for time sync..."
+        self.renderer.begin()
+        self.renderer.text(x, top,       "Started gardenpi")
+        self.renderer.text(x, top+20,    networkStatus)
+        self.renderer.text(x, top+30,    timeSync)
         # Display image.
-        self.disp.image(image)
-        self.disp.display()
-        return ready
+        self.pushFrame()
 
     def statusScreen(self):
         """
         Function to render the system status screen.
         """
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        width = self.disp.width
-        height = self.disp.height
-        image = Image.new('1', (width, height))
-        # Get drawing object to draw on image.
-        draw = ImageDraw.Draw(image)
-        # Draw a black filled box to clear the image.
-        draw.rectangle((0,0,width,height), outline=0, fill=0)
         # First define some constants to allow easy resizing of shapes.
         padding = -2
         top = padding
@@ -162,85 +187,56 @@ class DisplayHandler(threading.Thread):
         # Move left to right keeping track of the current x position for drawing shapes.
         x = 0
 
-        # Shell scripts for system monitoring from here :
-        # https://unix.stackexchange.com/questions/119126/command-to-display-memory-usage-disk-usage-and-cpu-load
-        #
-        #cmd = "top -bn1 | grep load | awk '{printf \"CPU Load: %.2f\", $(NF-2)}'"
-        #cmd = "free -m | awk 'NR==2{printf \"Mem: %s/%sMB %.2f%%\", $3,$2,$3*100/$2 }'"
-        #cmd = "df -h | awk '$NF==\"/\"{printf \"Disk: %d/%dGB %s\", $3,$2,$5}'"
-        cmd = "./stats.sh time"
-        Time = subprocess.check_output(cmd, shell = True )
-        cmd = "./stats.sh ip"
-        host = subprocess.check_output(cmd, shell = True )
-        cmd = "./stats.sh ssid"
-        wifi = subprocess.check_output(cmd, shell = True )
-        cmd = "./stats.sh signal"
-        signal = subprocess.check_output(cmd, shell = True )
-
-        draw.text((x, top),       str(Time.decode('utf-8')), font=self.font, fill=255)
-        draw.text((x, top+10),    str(host.decode('utf-8')), font=self.font, fill=255)
-        draw.text((x, top+20),    str(wifi.decode('utf-8')), font=self.font, fill=255)
-        draw.text((x, top+30),    str(signal.decode('utf-8')), font=self.font, fill=255)
+        # Values other than the time come from the stats thread cache,
+        # rendering never waits for the system
+        self.renderer.begin()
+        self.renderer.text(x, top,       self.stats.getTime())
+        self.renderer.text(x, top+10,    self.stats.getIp())
+        self.renderer.text(x, top+20,    self.stats.getSsid())
+        self.renderer.text(x, top+30,    self.stats.getSignal())
+        if self.flowMeter is not None:
+            runLitres, _, openChannels = self.flowMeter.volumes()
+            self.renderer.text(x, top+40, f"Flow: {self.flowMeter.rate():.1f} L/min")
+            if openChannels:
+                channel = openChannels[0]
+                self.renderer.text(x, top+50, f"CH{channel}: {runLitres[channel]:.1f} L")
 
         # Display image.
-        self.disp.image(image)
-        self.disp.display()
+        self.pushFrame()
 
     def channelSelScreen(self):
         """
         Function to render the channel selection screen.
         """
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        width = self.disp.width
-        height = self.disp.height
-        image = Image.new('1', (width, height))
-        # Get drawing object to draw on image.
-        draw = ImageDraw.Draw(image)
-        # Draw a black filled box to clear the image.
-        draw.rectangle((0,0,width,height), outline=0, fill=0)
         # First define some constants to allow easy resizing of shapes.
         padding = -2
         top = padding
         #bottom = height-padding
         # Move left to right keeping track of the current x position for drawing shapes.
         x = 0
-        draw.text((x, top),       str("Select Channel:"), font=self.font, fill=255)
-        draw.line([(x,top+10),(width,top+10)], fill=255)
+        self.renderer.begin()
+        self.renderer.text(x, top,       "Select Channel:")
+        self.renderer.hline(top+10)
         y = top+12
-        for ch in range(self.startLine,self.startLine+5):
-            config = self.chConfigs[ch-1]
+        for ch in range(self.startLine,min(self.startLine+5,self.channelCount+1)):
+            config = self.channelConfig(ch)
             if config.getEnabled():
                 state = "OFF til" if config.getState() == queueCmd.CHANNEL_WAITING else "ON til"
                 state+= f" {startTimeString(config.getNextTransition())}"
             else:
                 state = "DISABLED"
             line = f"CH{ch} {state}"
-            if ch == self.currentLine:
-                draw.rectangle((x,y,width,y+10), outline=0, fill=255)
-                draw.text((x+1, y), line, font=self.font, fill=0)
-            else:
-                draw.text((x+1, y), line, font=self.font, fill=255)
+            self.renderer.text(x+1, y, line, ch == self.currentLine)
             y+= 10
 
         # Display image.
-        self.disp.image(image)
-        self.disp.display()
+        self.pushFrame()
 
     def channelStatusScreen(self):
         """
         Function to render the channel status screen.
         """
-        config = self.chConfigs[self.selChannel-1]
-        # Create blank image for drawing.
-        # Make sure to create image with mode '1' for 1-bit color.
-        width = self.disp.width
-        height = self.disp.height
-        image = Image.new('1', (width, height))
-        # Get drawing object to draw on image.
-        draw = ImageDraw.Draw(image)
-        # Draw a black filled box to clear the image.
-        draw.rectangle((0,0,width,height), outline=0, fill=0)
+        config = self.channelConfig(self.selChannel)
         # First define some constants to allow easy resizing of shapes.
         padding = -2
         top = padding
@@ -253,8 +249,9 @@ class DisplayHandler(threading.Thread):
         else:
             state = ""
         line = f"CH{self.selChannel}: {state}"
-        draw.text((x, top), line, font=self.font, fill=255)
-        draw.line([(x,top+10),(width,top+10)], fill=255)
+        self.renderer.begin()
+        self.renderer.text(x, top, line)
+        self.renderer.hline(top+10)
         y = top+12
         enabled = config.getEnabled()!=0
         for prop in range(1,6):
@@ -270,16 +267,11 @@ class DisplayHandler(threading.Thread):
                 line = "Back"
             else:
                 line = ""
-            if prop == self.currentLine:
-                draw.rectangle((x,y,width,y+10), outline=0, fill=255)
-                draw.text((x+1, y), line, font=self.font, fill=0)
-            else:
-                draw.text((x+1, y), line, font=self.font, fill=255)
+            self.renderer.text(x+1, y, line, prop == self.currentLine)
             y+= 10
 
         # Display image.
-        self.disp.image(image)
-        self.disp.display()
+        self.pushFrame()
 
     def nextState(self,channel):
         """
@@ -318,7 +310,7 @@ class DisplayHandler(threading.Thread):
             elif self.state == STATE_SHOW_STATUS:
                 self.endscreen = time.time() + 30
             elif self.state == STATE_CHANNEL_SEL:
-                if self.currentLine < 8:
+                if self.currentLine < self.channelCount:
                     self.currentLine+=1
                     if (self.startLine + 4) < self.currentLine:
                         self.startLine = self.currentLine-4
@@ -355,56 +347,123 @@ class DisplayHandler(threading.Thread):
             logging.error("Wrong button")
         self.q.put(queueCmd.QueueCommand(queueCmd.CMD_WAKE_UP))
 
+    def showsChannel(self, channel):
+        """
+        Return True if the current screen shows the
+        status of a channel
+        """
+        if self.state == STATE_CHANNEL_SEL:
+            return self.startLine <= channel < self.startLine + 5
+        if self.state == STATE_CHANNEL_STATUS:
+            return channel == self.selChannel
+        return False
+
+    def nextRefresh(self, currentTime):
+        """
+        Return the time at which the current screen must be
+        redrawn even if no event arrives, or None if it only
+        changes on events.
+        The status screen shows a clock, so it is redrawn every
+        second. The channel screens show times of day, which only
+        change when a new status arrives or the day changes.
+        All screens are cleared when endscreen is reached.
+        """
+        deadlines = []
+        if self.endscreen != 0:
+            deadlines.append(self.endscreen)
+        if self.state == STATE_SHOW_STATUS:
+            deadlines.append(math.floor(currentTime) + 1)
+        elif self.state in (STATE_CHANNEL_SEL, STATE_CHANNEL_STATUS):
+            deadlines.append(schedule.nextDayStart(currentTime))
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def handleCommand(self, cmd):
+        """
+        Process a command received on the thread queue, marking
+        the screen for redraw if it affects what is shown.
+        Returns False if the thread must exit
+        """
+        if cmd.getType() == queueCmd.CMD_CHANNEL_CFG:
+            self.chConfigs[cmd.getChannel()] = cmd
+            if self.showsChannel(cmd.getChannel()):
+                self.dirty = True
+        elif cmd.getType() == queueCmd.CMD_WAKE_UP:
+            self.dirty = True
+        elif cmd.getType() == queueCmd.CMD_BOOT_DONE:
+            if self.state == STATE_BOOT:
+                self.state = STATE_SHOW_STATUS
+                self.endscreen = time.time() + 30
+                self.dirty = True
+        elif cmd.getType() == queueCmd.CMD_QUIT:
+            return False
+        return True
+
     def screenStateMachine(self):
         """
         Function that handles the actual rendering of screens
-        It is called every second when the thread's queue timeouts,
-        therefore each screen is refreshed at least every second.
-        It is also called in response to a wake up command, so the
-        screen responds inmediately to button presses and configuration/status
-        changes.
+        It is called when the screen is marked for redraw by a
+        button press or a status change of a channel shown, and
+        when the deadline returned by nextRefresh() is reached.
         """
         currentTime = time.time()
+        startTime = time.perf_counter()
+        self.dirty = False
         if((self.endscreen != 0) and (self.endscreen <= currentTime) ):
             self.clearScreen()
             self.endscreen = 0
             self.state = STATE_CLEAR_SCREEN
+        elif self.state == STATE_BOOT:
+            self.bootScreen()
         elif self.state == STATE_SHOW_STATUS:
             self.statusScreen()
         elif self.state == STATE_CHANNEL_SEL:
             self.channelSelScreen()
         elif self.state == STATE_CHANNEL_STATUS:
             self.channelStatusScreen()
+        # The system values are only read while the status screen is shown
+        self.stats.setActive(self.state == STATE_SHOW_STATUS)
+        frameTime.observe(time.perf_counter() - startTime)
 
     def run(self):
         try:
             logging.info("Display thread starting")
             # Initialize library.
             self.disp.begin()
+            self.stats.start()
             self.clearScreen()
-            self.state = STATE_SHOW_STATUS
-            self.endscreen = time.time() + 30
+            self.dirty = True
 
             gpios.addUpButtonCallback(self.nextState)
             gpios.addDownButtonCallback(self.nextState)
             gpios.addSelButtonCallback(self.nextState)
             while True:
+                if self.dirty:
+                    self.screenStateMachine()
+                deadline = self.nextRefresh(time.time())
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(0, deadline - time.time())
                 try:
-                    cmd = self.q.get(block=True,timeout=1)
+                    cmd = self.q.get(block=True,timeout=timeout)
                     self.q.task_done()
-                    if cmd.getType() == queueCmd.CMD_CHANNEL_CFG:
-                        index = cmd.getChannel()-1
-                        self.chConfigs.pop(index)
-                        self.chConfigs.insert(index,cmd)
-                    elif cmd.getType() == queueCmd.CMD_WAKE_UP:
-                        self.screenStateMachine()
-                    elif cmd.getType() == queueCmd.CMD_QUIT:
+                    running = self.handleCommand(cmd)
+                    # Process everything pending before redrawing,
+                    # so a burst of updates causes a single redraw
+                    while running and not self.q.empty():
+                        cmd = self.q.get(block=False)
+                        self.q.task_done()
+                        running = self.handleCommand(cmd)
+                    if not running:
+                        self.stats.stop()
                         self.disp.clear()
                         self.disp.display()
                         logging.warning("Display thread exiting")
                         return
                 except queue.Empty:
-                    self.screenStateMachine()
+                    self.dirty = True
         except Exception:  # pylint: disable="broad-exception-caught"
             logging.exception("Exception on display thread")
             self.disp.clear()
@@ -0,0 +1,194 @@
+"""
+events - Channel state and configuration events from the
+controller to the API server.
+The controller sends every status it gives the display as a
+JSON message on a local SOCK_SEQPACKET socket, one connection
+per API server process. Sends never block the scheduler: a
+subscriber too slow to take a message loses it.
+The API server keeps a single connection in an EventHub and
+fans the events out to its stream clients, so the number of
+clients doesn't change the work done by the controller.
+"""
+import json
+import queue
+import socket
+import logging
+import threading
+import time
+import status
+
+# Linux abstract namespace socket, no file to clean up
+EVENTS_ADDRESS = "\0gardenpi.events"
+MAX_EVENT_SIZE = 4096
+RECONNECT_S = 5
+# Events kept per stream client before it is considered too slow
+CLIENT_QUEUE_SIZE = 64
+
+# Event names, telling why the scheduler published the status
+EVENT_CONFIG = "config"
+EVENT_TRANSITION = "transition"
+EVENT_SYNC = "sync"
+
+
+def statusEvent(event, cmd, eventTime):
+    # pylint: disable="invalid-name"
+    """
+    Return the event for a channel status command as a dict
+    """
+    return {"event": event,
+            "time": eventTime,
+            "channel": cmd.getChannel(),
+            "state": status.STATE_NAMES.get(cmd.getState(), "off"),
+            "nextTransition": cmd.getNextTransition(),
+            "delay": cmd.getDelay(),
+            "enabled": cmd.getEnabled(),
+            "period": cmd.getPeriod(),
+            "duration": cmd.getDuration(),
+            "start": cmd.getStartTime(),
+            "starts": cmd.getExtraStartTimes(),
+            "weekdays": cmd.getWeekdays(),
+            "anchor": cmd.getAnchor()}
+
+
+class EventBroadcaster(threading.Thread):
+    # pylint: disable="invalid-name"
+    """
+    Controller side. The thread only accepts subscribers,
+    events are sent by the caller of publish().
+    """
+    def __init__(self, address=EVENTS_ADDRESS, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.dropped = 0
+        super().__init__(*args, **kwargs)
+
+    def publish(self, event):
+        """
+        Send an event to every subscriber without blocking
+        """
+        data = json.dumps(event).encode("utf-8")
+        with self.lock:
+            for sock in list(self.subscribers):
+                try:
+                    sock.send(data, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    self.dropped += 1
+                except OSError:
+                    self.subscribers.remove(sock)
+                    sock.close()
+
+    def stop(self):
+        """
+        Stop accepting subscribers and disconnect them
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            for sock in self.subscribers:
+                sock.close()
+            self.subscribers = []
+
+    def run(self):
+        try:
+            self.sock.bind(self.address)
+            self.sock.listen(4)
+        except OSError:
+            logging.warning("Can't bind events socket, events not sent")
+            return
+        logging.info("Events thread starting")
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                logging.info("Events thread exiting")
+                return
+            conn.shutdown(socket.SHUT_RD)
+            with self.lock:
+                self.subscribers.append(conn)
+
+
+class EventHub():
+    # pylint: disable="invalid-name"
+    """
+    API server side. One thread receives the controller events
+    and puts them in the queue of every client. A client whose
+    queue is full is dropped, it will reconnect.
+    """
+    def __init__(self, address=EVENTS_ADDRESS):
+        self.address = address
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.eventId = 0
+        self.thread = None
+
+    def subscribe(self):
+        """
+        Return a new client queue, starting the receiving
+        thread on first use. Events are (id, dict) tuples, None
+        means the client was dropped.
+        """
+        clientQueue = queue.Queue(CLIENT_QUEUE_SIZE)
+        with self.lock:
+            self.clients.add(clientQueue)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.receive, daemon=True)
+                self.thread.start()
+        return clientQueue
+
+    def unsubscribe(self, clientQueue):
+        """
+        Stop sending events to a client
+        """
+        with self.lock:
+            self.clients.discard(clientQueue)
+
+    def dispatch(self, event):
+        """
+        Put an event in the queue of every client
+        """
+        with self.lock:
+            self.eventId += 1
+            for clientQueue in list(self.clients):
+                try:
+                    clientQueue.put_nowait((self.eventId, event))
+                except queue.Full:
+                    self.clients.discard(clientQueue)
+                    # Make room for the end of stream marker
+                    try:
+                        clientQueue.get_nowait()
+                    except queue.Empty:
+                        pass
+                    clientQueue.put_nowait(None)
+
+    def receive(self):
+        """
+        Receive the controller events forever, reconnecting
+        when the controller restarts
+        """
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as sock:
+                    sock.connect(self.address)
+                    while True:
+                        data = sock.recv(MAX_EVENT_SIZE)
+                        if not data:
+                            break
+                        self.dispatch(json.loads(data))
+            except (OSError, ValueError):
+                pass
+            time.sleep(RECONNECT_S)
+
+
+def streamFormat(eventId, event):
+    # pylint: disable="invalid-name"
+    """
+    Return an event in the Server-Sent Events format
+    """
+    return f"id: {eventId}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
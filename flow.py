@@ -0,0 +1,405 @@
+"""
+flow - Flow meter on the main line and the water volume of
+each channel.
+A hall effect meter gives a pulse per fixed volume, hundreds
+per second at full flow, too many for a Python callback per
+pulse. Pulses are captured as edge events of the GPIO character
+device instead: the kernel timestamps every edge and queues it,
+and the reader collects the queue in batches, copying the
+timestamps into a preallocated ring with slice copies. No Python
+code runs per pulse. The rate is computed over a time window of
+the ring, and the volume of each batch goes to the channels that
+are on, shared evenly when several are.
+The pulse source can be replaced, see SimPulseSource.
+"""
+import os
+import time
+import array
+import fcntl
+import select
+import struct
+import logging
+import threading
+import gpios
+import queueCmd
+import metrics
+
+GPIO_CHIP = "/dev/gpiochip0"
+# YF-S201 type meters, about 7.5 Hz per litre per minute
+PULSES_PER_LITRE = 450
+
+# Timestamps kept, over 8 seconds of pulses at 500 Hz
+RING_SIZE = 4096
+# Seconds of pulses the rate is computed over
+RATE_WINDOW_S = 5
+# Seconds pulses are left to queue in the kernel between reads
+BATCH_INTERVAL_S = 0.1
+# Seconds between updates of the status snapshot while water flows
+STATUS_INTERVAL_S = 1
+
+# GPIO character device v2 ABI, see linux/gpio.h
+GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+# struct gpio_v2_line_request and the offsets of its fields
+LINE_REQUEST_SIZE = 592
+REQUEST_CONSUMER = 256
+REQUEST_FLAGS = 288
+REQUEST_NUM_LINES = 560
+REQUEST_FD = 588
+# Largest kernel queue of a single line request
+EVENT_BUFFER_SIZE = 1024
+# struct gpio_v2_line_event, 6 64-bit words: the timestamp is
+# the first, line_seqno is 32-bit word 5
+EVENT_SIZE = 48
+EVENT_WORDS = EVENT_SIZE // 8
+EVENT_SEQNO_INDEX = 5
+EVENT_INTS = EVENT_SIZE // 4
+
+pulsesCounted = metrics.counter("gardenpi_flow_pulses_total", "Flow meter pulses counted")
+pulsesLost = metrics.counter("gardenpi_flow_pulses_lost_total",
+                             "Flow meter pulses counted without a timestamp, "
+                             "the kernel queue was full")
+
+
+class PulseRing():
+    # pylint: disable="invalid-name"
+    """
+    Preallocated ring of pulse timestamps in nanoseconds.
+    Blocks of timestamps are copied in, the oldest ones are
+    overwritten. total counts every pulse added, including
+    those that came without a timestamp.
+    """
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self.stamps = array.array("Q", bytes(8 * size))
+        self.view = memoryview(self.stamps)
+        # Next index written and timestamps held
+        self.head = 0
+        self.held = 0
+        self.total = 0
+
+    def extend(self, stamps, pulses=None):
+        """
+        Add a block of timestamps in time order, a memoryview
+        of unsigned 64-bit values. pulses is the number of
+        pulses the block stands for, if some have no timestamp.
+        """
+        count = len(stamps)
+        self.total += count if pulses is None else pulses
+        if count > self.size:
+            stamps = stamps[count - self.size:]
+            count = self.size
+        first = min(count, self.size - self.head)
+        self.view[self.head:self.head + first] = stamps[:first]
+        self.view[:count - first] = stamps[first:]
+        self.head = (self.head + count) % self.size
+        self.held = min(self.size, self.held + count)
+
+    def countSince(self, since):
+        """
+        Return the number of timestamps at or after since
+        """
+        base = self.head - self.held
+        low, high = 0, self.held
+        while low < high:
+            middle = (low + high) // 2
+            if self.stamps[(base + middle) % self.size] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return self.held - low
+
+    def rate(self, now, window=RATE_WINDOW_S):
+        """
+        Return the pulses per second over the window seconds
+        before now, in nanoseconds
+        """
+        return self.countSince(now - int(window * 1e9)) / window
+
+
+class GpioChipPulseSource():
+    # pylint: disable="invalid-name"
+    """
+    Pulses of a GPIO line, read as edge events of the GPIO
+    character device. The meter output is open collector, the
+    line is pulled up and falling edges are counted. The kernel
+    numbers the edges, so pulses dropped from a full queue are
+    still counted.
+    """
+    def __init__(self, line=gpios.FLOW_GPIO, chip=GPIO_CHIP):
+        request = bytearray(LINE_REQUEST_SIZE)
+        struct.pack_into("<I", request, 0, line)
+        struct.pack_into("32s", request, REQUEST_CONSUMER, b"gardenpi-flow")
+        struct.pack_into("<Q", request, REQUEST_FLAGS,
+                         GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_FALLING |
+                         GPIO_V2_LINE_FLAG_BIAS_PULL_UP)
+        struct.pack_into("<II", request, REQUEST_NUM_LINES, 1, EVENT_BUFFER_SIZE)
+        chipFd = os.open(chip, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(chipFd, GPIO_V2_GET_LINE_IOCTL, request)
+        finally:
+            os.close(chipFd)
+        self.fd = struct.unpack_from("<i", request, REQUEST_FD)[0]
+        os.set_blocking(self.fd, False)
+        self.buffer = bytearray(EVENT_BUFFER_SIZE * EVENT_SIZE)
+        self.words = memoryview(self.buffer).cast("Q")
+        self.ints = memoryview(self.buffer).cast("I")
+        self.lineSeqno = 0
+
+    def fileno(self):
+        """
+        Return the descriptor readable when pulses are queued
+        """
+        return self.fd
+
+    def now(self):
+        """
+        Return the current time on the clock of the timestamps
+        """
+        return time.monotonic_ns()
+
+    def read(self, ring):
+        """
+        Move the queued pulses to the ring. Returns the number
+        of pulses
+        """
+        pulses = 0
+        while True:
+            try:
+                size = os.readv(self.fd, [self.buffer])
+            except BlockingIOError:
+                break
+            events = size // EVENT_SIZE
+            if events == 0:
+                break
+            lineSeqno = self.ints[(events - 1) * EVENT_INTS + EVENT_SEQNO_INDEX]
+            count = (lineSeqno - self.lineSeqno) & 0xffffffff
+            self.lineSeqno = lineSeqno
+            ring.extend(self.words[0:events * EVENT_WORDS:EVENT_WORDS], count)
+            if count > events:
+                pulsesLost.inc(count - events)
+            pulses += count
+            if size < len(self.buffer):
+                break
+        return pulses
+
+    def close(self):
+        """
+        Release the line
+        """
+        os.close(self.fd)
+
+
+class SimPulseSource():
+    # pylint: disable="invalid-name"
+    """
+    Pulses of a simulated meter at the flow given by setFlow().
+    Times come from timeSource in seconds, for example the virtual
+    clock of simulation.py. The pulses are generated when read,
+    so the pending ones must be collected before the flow changes.
+    """
+    def __init__(self, pulsesPerLitre=PULSES_PER_LITRE, timeSource=time.monotonic):
+        self.pulsesPerLitre = pulsesPerLitre
+        self.timeSource = timeSource
+        self.frequency = 0
+        self.nextPulse = 0
+
+    def fileno(self):
+        """
+        There is no descriptor to wait on, the meter polls
+        """
+        return None
+
+    def now(self):
+        """
+        Return the current time on the clock of the timestamps
+        """
+        return round(self.timeSource() * 1e9)
+
+    def setFlow(self, litresPerMinute):
+        """
+        Set the flow through the meter from now on
+        """
+        frequency = litresPerMinute * self.pulsesPerLitre / 60
+        if frequency > 0 and self.frequency <= 0:
+            self.nextPulse = self.timeSource() + 1 / frequency
+        self.frequency = frequency
+
+    def read(self, ring):
+        """
+        Add the pulses up to now to the ring. Returns the number
+        of pulses
+        """
+        now = self.timeSource()
+        if self.frequency <= 0 or now < self.nextPulse:
+            return 0
+        pulses = int((now - self.nextPulse) * self.frequency) + 1
+        # Only the timestamps the ring can hold are generated
+        skipped = max(0, pulses - ring.size)
+        stamps = array.array("Q", (round((self.nextPulse + index / self.frequency) * 1e9)
+                                   for index in range(skipped, pulses)))
+        self.nextPulse += pulses / self.frequency
+        ring.extend(memoryview(stamps), pulses)
+        return pulses
+
+    def close(self):
+        """
+        Nothing to release
+        """
+
+
+class FlowMeter(threading.Thread):
+    # pylint: disable="invalid-name,too-many-instance-attributes"
+    """
+    Flow meter thread. It sleeps until a pulse arrives, then
+    collects the pulses every BATCH_INTERVAL_S while water flows.
+    The scheduler tells it when channels turn on and off, the
+    volume of each batch goes to the channels on, or counts as
+    unattributed if there are none. Without a descriptor to wait
+    on, as with the simulated source, it polls.
+    """
+    def __init__(self, source, pulsesPerLitre=PULSES_PER_LITRE, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.source = source
+        self.litresPerPulse = 1 / pulsesPerLitre
+        self.ring = PulseRing()
+        self.lock = threading.Lock()
+        self.openChannels = []
+        # Litres of the current or last run of each channel, and
+        # since the controller started
+        self.runLitres = {}
+        self.totalLitres = {}
+        # Litres that flowed with every channel off, a leak
+        # or a tap on the main line
+        self.unattributed = 0
+        self.statusWriter = None
+        self.publishedRate = 0
+        self.nextPublish = 0
+        self.stopping = False
+        self.wakeRead, self.wakeWrite = os.pipe()
+        metrics.gauge("gardenpi_flow_litres_per_minute", "Flow through the meter", self.rate)
+        metrics.gauge("gardenpi_flow_unattributed_litres_total",
+                      "Litres that flowed with every channel off",
+                      lambda: self.unattributed, kind="counter")
+        super().__init__(*args, **kwargs)
+
+    def setStatusWriter(self, statusWriter):
+        """
+        Also publish the rate and run volumes to the shared snapshot
+        """
+        self.statusWriter = statusWriter
+
+    def collectPending(self):
+        """
+        Attribute the pulses queued so far. Called with the lock held
+        """
+        pulses = self.source.read(self.ring)
+        if not pulses:
+            return
+        pulsesCounted.inc(pulses)
+        litres = pulses * self.litresPerPulse
+        if not self.openChannels:
+            self.unattributed += litres
+            return
+        share = litres / len(self.openChannels)
+        for channel in self.openChannels:
+            self.runLitres[channel] += share
+            self.totalLitres[channel] = self.totalLitres.get(channel, 0) + share
+
+    def channelOn(self, channel):
+        """
+        Attribute the flow to a channel from now on, starting
+        a new run volume
+        """
+        with self.lock:
+            self.collectPending()
+            if channel not in self.openChannels:
+                self.openChannels.append(channel)
+            self.runLitres[channel] = 0
+
+    def channelOff(self, channel):
+        """
+        Stop attributing the flow to a channel. Returns the
+        litres of its run
+        """
+        with self.lock:
+            self.collectPending()
+            if channel in self.openChannels:
+                self.openChannels.remove(channel)
+            return self.runLitres.get(channel, 0)
+
+    def rate(self):
+        """
+        Return the flow in litres per minute over the last
+        RATE_WINDOW_S seconds
+        """
+        with self.lock:
+            return self.ring.rate(self.source.now()) * self.litresPerPulse * 60
+
+    def volumes(self):
+        """
+        Return copies of the run and total litres by channel,
+        and the channels on
+        """
+        with self.lock:
+            return dict(self.runLitres), dict(self.totalLitres), list(self.openChannels)
+
+    def step(self):
+        """
+        Collect the pending pulses and update the snapshot if it
+        is due. Returns the seconds to wait for pulses before the
+        next step, None for no limit.
+        """
+        with self.lock:
+            self.collectPending()
+        rate = self.rate()
+        now = time.monotonic()
+        # The snapshot is updated when the water stops or starts
+        # flowing, and every STATUS_INTERVAL_S while it flows
+        if self.statusWriter is not None and (now >= self.nextPublish or
+                                              (rate == 0) != (self.publishedRate == 0)):
+            runLitres, _, _ = self.volumes()
+            self.statusWriter.updateFlow(rate, runLitres)
+            self.publishedRate = rate
+            self.nextPublish = now + STATUS_INTERVAL_S
+        if self.source.fileno() is None:
+            return BATCH_INTERVAL_S
+        return None if rate == 0 else STATUS_INTERVAL_S
+
+    def stop(self):
+        """
+        Make the thread exit
+        """
+        self.stopping = True
+        os.write(self.wakeWrite, b"\0")
+
+    def close(self):
+        """
+        Release the pulse source
+        """
+        self.source.close()
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+
+    def run(self):
+        try:
+            logging.info("Flow meter thread starting")
+            poller = select.poll()
+            poller.register(self.wakeRead, select.POLLIN)
+            if self.source.fileno() is not None:
+                poller.register(self.source.fileno(), select.POLLIN)
+            timeout = self.step()
+            while not self.stopping:
+                ready = poller.poll(None if timeout is None else timeout * 1000)
+                if self.stopping:
+                    break
+                if ready:
+                    # Let the pulses queue up, they are read in batches
+                    time.sleep(BATCH_INTERVAL_S)
+                timeout = self.step()
+            logging.info("Flow meter thread exiting")
+        except Exception:  # pylint: disable="broad-exception-caught"
+            logging.exception("Exception on flow meter thread")
+            queueCmd.globalExit = True
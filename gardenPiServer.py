@@ -1,15 +1,44 @@
-import sqlite3
-from flask import Flask, jsonify, request, g
+import time
+import queue
+import hashlib
+import functools
+from flask import Flask, Response, jsonify, request, g
+import notify
+import metrics
+import status
+import events
+import storage
+import schedule
+import timeseries
 
 app = Flask(__name__)
 
-DATABASE = "gardenpi.sqlite"
+# Connections are reused across requests
+dbPool = storage.ConnectionPool()
+# Serialized responses of DB queries by path and arguments, valid
+# while the DB version they were built from is current
+dbWatcher = storage.ChangeWatcher()
+responseCache = {}
+RESPONSE_CACHE_SIZE = 256
+
+# Live channel state published by the controller
+statusReader = status.StatusReader()
+# Controller events, shared by all the stream clients of this process
+eventHub = events.EventHub()
+# Seconds between comments sent to idle stream clients
+STREAM_KEEPALIVE_S = 15
+
+# The anchor the period counts from is the one given, or today if the period
+# changes or none is stored
+UPDATE_CHANNEL = ('UPDATE configuration set enabled=?,period_s=?,duration_s=?,startTimeOfDay=?,'
+                  'extraStartTimes=COALESCE(?,extraStartTimes),weekdays=COALESCE(?,weekdays),'
+                  'anchor=COALESCE(?,CASE WHEN period_s=? AND anchor<>0 THEN anchor ELSE ? END),'
+                  'updated=1 WHERE channel=?')
 
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = dbPool.acquire()
     return db
 
 def query_db(query, args=(), one=False):
@@ -18,31 +47,93 @@ def query_db(query, args=(), one=False):
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
+def channel_dict(row):
+    return {"channel":row['channel'],"enabled":row['enabled'],"period":row['period_s'],"duration":row['duration_s'],"start":row['startTimeOfDay'],
+            "starts":schedule.parseStartTimes(row['extraStartTimes']),"weekdays":row['weekdays'],
+            "anchor":row['anchor']}
+
+def channel_params(req, chan):
+    # Extra start times, weekdays and anchor are optional, keep the stored values if missing.
+    # The anchor can be any time of the day the period should count from
+    starts = schedule.formatStartTimes(req['starts']) if 'starts' in req else None
+    anchor = schedule.startOfDay(req['anchor']) if 'anchor' in req else None
+    return (req['enabled'],req['period'],req['duration'],req['start'],starts,req.get('weekdays'),
+            anchor,req['period'],schedule.startOfDay(time.time()),chan)
+
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def channel_errors(req, channels):
+    if not isinstance(req, dict):
+        return ["configuration must be an object"]
+    errors = []
+    if req.get('channel') not in channels:
+        errors.append("unknown channel")
+    for key in ('enabled', 'period', 'duration', 'start'):
+        if not is_count(req.get(key)):
+            errors.append(f"{key} must be a non negative integer")
+    # A period of 0 repeats the start times every day, see schedule
+    if req.get('enabled') not in (0, 1):
+        errors.append("enabled must be 0 or 1")
+    if is_count(req.get('start')) and req['start'] >= schedule.DAY_SECONDS:
+        errors.append("start must be a time of day in seconds")
+    if 'starts' in req and (not isinstance(req['starts'], list) or
+                            not all(is_count(start) and start < schedule.DAY_SECONDS for start in req['starts'])):
+        errors.append("starts must be a list of times of day in seconds")
+    if 'weekdays' in req and not (is_count(req['weekdays']) and req['weekdays'] <= schedule.ALL_DAYS):
+        errors.append(f"weekdays must be a day mask between 0 and {schedule.ALL_DAYS}")
+    if 'anchor' in req and not is_count(req['anchor']):
+        errors.append("anchor must be a timestamp")
+    return errors
+
+def db_cached(view):
+    # Serves DB reads from the response cache, with ETag
+    # and Last-Modified so clients can revalidate and get a 304
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        version, changeTime = dbWatcher.current()
+        key = request.full_path
+        entry = responseCache.get(key)
+        if entry is None or entry[0] != version:
+            res = view(*args, **kwargs)
+            if not isinstance(res, Response) or res.status_code != 200:
+                return res
+            body = res.get_data()
+            entry = (version, changeTime, hashlib.blake2b(body, digest_size=12).hexdigest(), body)
+            if len(responseCache) >= RESPONSE_CACHE_SIZE:
+                responseCache.clear()
+            responseCache[key] = entry
+        res = Response(entry[3], mimetype="application/json")
+        res.set_etag(entry[2])
+        res.last_modified = entry[1]
+        res.cache_control.no_cache = True
+        return res.make_conditional(request)
+    return cached_view
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
+        dbPool.release(db)
 
 @app.route('/channels')
+@db_cached
 def get_channels():
     try:
         res = []
         for row in query_db('SELECT * from configuration'):
-            channel = {"channel":row['channel'],"enabled":row['enabled'],"period":row['period_s'],"duration":row['duration_s'],"start":row['startTimeOfDay']}
-            res.append(channel)
+            res.append(channel_dict(row))
         return jsonify(res)
     except Exception:
         app.logger.exception("Exception on channels query")
         return '{"error":"channels query failed"}', 500
 
 @app.route('/channel/<int:chan>')
+@db_cached
 def get_channel(chan):
     try:
         res = query_db('SELECT * from configuration WHERE channel=?',(chan,))
-        row = res[0]
-        channel = {"channel":row['channel'],"enabled":row['enabled'],"period":row['period_s'],"duration":row['duration_s'],"start":row['startTimeOfDay']}
-        return jsonify(channel)
+        return jsonify(channel_dict(res[0]))
     except Exception:
         app.logger.exception("Exception on channel query")
         return '{"error":"channel query failed"}', 500
@@ -51,9 +142,228 @@ def get_channel(chan):
 def post_channel(chan):
     try:
         req = request.get_json()
-        query_db('UPDATE configuration set enabled=?,period_s=?,duration_s=?,startTimeOfDay=?,updated=1 WHERE channel=?',(req['enabled'],req['period'],req['duration'],req['start'],chan))
-        get_db().commit()
+        with storage.transaction(get_db()):
+            query_db(UPDATE_CHANNEL, channel_params(req, chan))
+        notify.notifyConfigChange()
         return '', 204
     except Exception:
         app.logger.exception("Exception on channel update")
         return '{"error":"channel update failed"}', 500
+
+@app.route('/channels', methods=['POST'])
+def post_channels():
+    # Configures several channels at once. Every configuration is
+    # validated first, then all are written in one transaction, so
+    # the controller picks up the whole batch in one DB check
+    try:
+        req = request.get_json(silent=True)
+        if not isinstance(req, list):
+            return jsonify({"error":"a list of channel configurations is expected"}), 400
+        channels = {row['channel'] for row in query_db('SELECT channel from configuration')}
+        errors = []
+        seen = set()
+        for index, config in enumerate(req):
+            configErrors = channel_errors(config, channels)
+            if not configErrors and config['channel'] in seen:
+                configErrors.append("channel configured twice")
+            if configErrors:
+                errors.append({"index":index,"channel":config.get('channel') if isinstance(config, dict) else None,
+                               "errors":configErrors})
+            else:
+                seen.add(config['channel'])
+        if errors:
+            return jsonify({"error":"invalid channel configurations","details":errors}), 400
+        if req:
+            with storage.transaction(get_db()) as db:
+                db.executemany(UPDATE_CHANNEL, [channel_params(config, config['channel']) for config in req])
+            notify.notifyConfigChange()
+        return '', 204
+    except Exception:
+        app.logger.exception("Exception on channels update")
+        return '{"error":"channels update failed"}', 500
+
+
+@app.route('/runs')
+def get_runs():
+    try:
+        count = request.args.get('count', 10, type=int)
+        now = time.time()
+        schedules = {}
+        for row in query_db('SELECT * from configuration WHERE enabled=1'):
+            schedules[row['channel']] = schedule.Schedule(row['period_s'],row['duration_s'],
+                                                          [row['startTimeOfDay']]+schedule.parseStartTimes(row['extraStartTimes']),
+                                                          row['weekdays'],row['anchor'])
+        res = []
+        for start, end, chan in schedule.nextRuns(schedules, now, count):
+            res.append({"channel":chan,"start":start,"end":end})
+        return jsonify(res)
+    except Exception:
+        app.logger.exception("Exception on runs query")
+        return '{"error":"runs query failed"}', 500
+
+
+@app.route('/history')
+@db_cached
+def get_history():
+    # Runs started between since and until (timestamps), newest first
+    try:
+        channel = request.args.get('channel', type=int)
+        since = request.args.get('since', 0, type=float)
+        until = request.args.get('until', time.time(), type=float)
+        limit = min(request.args.get('limit', 100, type=int), 10000)
+        query = 'SELECT * from history WHERE actualStart>=? AND actualStart<?'
+        args = [since, until]
+        if channel is not None:
+            query += ' AND channel=?'
+            args.append(channel)
+        res = []
+        for row in query_db(query + ' ORDER BY actualStart DESC LIMIT ?', args + [limit]):
+            res.append({"channel":row['channel'],"scheduledStart":row['scheduledStart'],"start":row['actualStart'],
+                        "end":row['actualEnd'],"delay":row['delay'],"litres":row['litres']})
+        return jsonify(res)
+    except Exception:
+        app.logger.exception("Exception on history query")
+        return '{"error":"history query failed"}', 500
+
+# Grouping of the daily totals for each usage period
+USAGE_PERIODS = {"day": "day", "week": "strftime('%Y-W%W', day)", "month": "substr(day, 1, 7)",
+                 "year": "substr(day, 1, 4)"}
+
+@app.route('/usage')
+@db_cached
+def get_usage():
+    # Watering minutes and litres per channel and period, from the daily totals.
+    # since and until are local dates as YYYY-MM-DD, until included
+    try:
+        period = request.args.get('period', 'day')
+        if period not in USAGE_PERIODS:
+            return jsonify({"error":f"period must be one of {', '.join(USAGE_PERIODS)}"}), 400
+        channel = request.args.get('channel', type=int)
+        since = request.args.get('since', '0000-00-00')
+        until = request.args.get('until', '9999-99-99')
+        group = USAGE_PERIODS[period]
+        query = (f'SELECT {group} AS period, channel, sum(runs) AS runs, sum(seconds) AS seconds, '
+                 'sum(delaySeconds) AS delaySeconds, sum(litres) AS litres from dailyUsage WHERE day>=? AND day<=?')
+        args = [since, until]
+        if channel is not None:
+            query += ' AND channel=?'
+            args.append(channel)
+        res = []
+        for row in query_db(query + ' GROUP BY period, channel ORDER BY period, channel', args):
+            res.append({"period":row['period'],"channel":row['channel'],"runs":row['runs'],
+                        "minutes":row['seconds'] / 60,"delayMinutes":row['delaySeconds'] / 60,
+                        "litres":row['litres']})
+        return jsonify(res)
+    except Exception:
+        app.logger.exception("Exception on usage query")
+        return '{"error":"usage query failed"}', 500
+
+
+# Rollup resolutions of the sensor data, finest first
+SENSOR_RESOLUTIONS = {"minute": timeseries.MINUTE, "hour": timeseries.HOUR, "day": timeseries.DAY}
+SENSOR_POINTS = 500
+SENSOR_MAX_POINTS = 10000
+
+@app.route('/sensors')
+@db_cached
+def get_sensors():
+    # Sensors with recorded data, with the time range of each resolution
+    try:
+        names = {seconds: name for name, seconds in SENSOR_RESOLUTIONS.items()}
+        sensors = {}
+        for row in query_db('SELECT sensor, resolution, count(*) AS rows, min(bucket) AS first, '
+                            'max(bucket) AS last, unit from sensorData LEFT JOIN sensors ON name=sensor '
+                            'GROUP BY sensor, resolution ORDER BY sensor, resolution'):
+            sensor = sensors.setdefault(row['sensor'], {"sensor":row['sensor'],"unit":row['unit'] or '',
+                                                        "resolutions":{}})
+            sensor["resolutions"][names.get(row['resolution'], row['resolution'])] = {
+                "rows":row['rows'],"first":row['first'],"last":row['last']}
+        return jsonify(list(sensors.values()))
+    except Exception:
+        app.logger.exception("Exception on sensors query")
+        return '{"error":"sensors query failed"}', 500
+
+@app.route('/sensors/<name>')
+@db_cached
+def get_sensor(name):
+    # Rollups of a sensor between since and until (timestamps), oldest first.
+    # Without a resolution the finest one giving at most points rows is used,
+    # a year of data is read from 365 daily or 8784 hourly rows
+    try:
+        until = request.args.get('until', time.time(), type=float)
+        since = request.args.get('since', until - timeseries.DAY, type=float)
+        points = min(request.args.get('points', SENSOR_POINTS, type=int), SENSOR_MAX_POINTS)
+        resolution = request.args.get('resolution')
+        if resolution is None:
+            for resolution, seconds in SENSOR_RESOLUTIONS.items():
+                if (until - since) / seconds <= points:
+                    break
+        elif resolution not in SENSOR_RESOLUTIONS:
+            return jsonify({"error":f"resolution must be one of {', '.join(SENSOR_RESOLUTIONS)}"}), 400
+        seconds = SENSOR_RESOLUTIONS[resolution]
+        res = []
+        # The period containing since is included
+        for row in query_db('SELECT bucket, count, total, minimum, maximum from sensorData '
+                            'WHERE sensor=? AND resolution=? AND bucket>? AND bucket<? ORDER BY bucket LIMIT ?',
+                            (name, seconds, since - seconds, until, points)):
+            res.append({"time":row['bucket'],"mean":row['total'] / row['count'],"min":row['minimum'],
+                        "max":row['maximum'],"count":row['count']})
+        return jsonify({"sensor":name,"resolution":resolution,"points":res})
+    except Exception:
+        app.logger.exception("Exception on sensor query")
+        return '{"error":"sensor query failed"}', 500
+
+
+@app.route('/metrics')
+def get_metrics():
+    try:
+        return Response(metrics.read(), mimetype="text/plain; version=0.0.4")
+    except OSError:
+        app.logger.exception("Exception on metrics read")
+        return '{"error":"controller not reachable"}', 503
+
+
+@app.route('/status')
+def get_status():
+    try:
+        return jsonify(statusReader.read())
+    except OSError:
+        app.logger.exception("Exception on status read")
+        return '{"error":"controller status not available"}', 503
+
+
+@app.route('/status/<int:chan>')
+def get_channel_status(chan):
+    try:
+        snapshot = statusReader.read()
+        for channel in snapshot["channels"]:
+            if channel["channel"] == chan:
+                channel["version"] = snapshot["version"]
+                return jsonify(channel)
+        return '{"error":"unknown channel"}', 404
+    except OSError:
+        app.logger.exception("Exception on status read")
+        return '{"error":"controller status not available"}', 503
+
+
+@app.route('/events')
+def get_events():
+    # Server-Sent Events stream of channel transitions and configuration
+    # changes. Needs an async worker, see gardenpiapiserver.service
+    clientQueue = eventHub.subscribe()
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    item = clientQueue.get(timeout=STREAM_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    return
+                yield events.streamFormat(*item)
+        finally:
+            eventHub.unsubscribe(clientQueue)
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
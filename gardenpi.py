@@ -1,70 +1,576 @@
 #!/usr/bin/env python3
 
-"""gardenpi - 8 channel irrigation controller"""
+"""gardenpi - Irrigation controller for any number of channels"""
 
+import os
+import fcntl
 import logging
+import argparse
 import queue
+import signal
 import sys
+import sqlite3
 import threading
 import time
-import sqlite3
-import math
-import systemd_watchdog
+import heapq
 import gpios
-import control
 import queueCmd
+import notify
+import schedule
+import clock
+import planner
+import metrics
+import status
+import events
+import storage
+import history
+import runstate
+import flow
+import timeseries
+
+# Seconds between checks of the DB for changes made
+# by writers that don't use the notify socket
+DB_POLL_FALLBACK_S = 5
+# Seconds between saves of the last known time, it is saved on exit too
+SAVE_LAST_KNOWN_S = 3600
+
+# Settings table defaults.
+# maxOpenValves: valves allowed open at the same time, 0 for no limit
+# minStaggerSeconds: minimum time between two valves turning on
+# channelCount: channels of the installation, numbered from 1
+# display: DISPLAY_NONE, DISPLAY_FITTED, or DISPLAY_DETECT to use
+#          the OLED if it answers on the I2C bus
+# flowMeter: 1 if a flow meter is fitted on gpios.FLOW_GPIO
+# flowPulsesPerLitre: pulses given by the flow meter per litre
+# sensorIntervalSeconds: time between readings of the sensors
+DISPLAY_NONE = 0
+DISPLAY_FITTED = 1
+DISPLAY_DETECT = 2
+DEFAULT_SETTINGS = {
+    "maxOpenValves": 0,
+    "minStaggerSeconds": 1,
+    "channelCount": 8,
+    "display": DISPLAY_DETECT,
+    "flowMeter": 0,
+    "flowPulsesPerLitre": flow.PULSES_PER_LITRE,
+    "sensorIntervalSeconds": timeseries.SAMPLE_INTERVAL_S,
+}
+
+# SSD1306 OLED of the front panel
+OLED_I2C_BUS = 1
+OLED_I2C_ADDRESS = 0x3c
+I2C_SLAVE = 0x0703
+
+onLatency = metrics.histogram("gardenpi_actuation_latency_seconds",
+                              "Time from a transition deadline to the relay switched",
+                              {"edge": "on"})
+offLatency = metrics.histogram("gardenpi_actuation_latency_seconds",
+                               "Time from a transition deadline to the relay switched",
+                               {"edge": "off"})
+plannerDelay = metrics.histogram("gardenpi_planner_delay_seconds",
+                                 "Start delay given by the actuation planner",
+                                 buckets=metrics.DELAY_BUCKETS)
+dbPollTime = metrics.histogram("gardenpi_db_poll_seconds", "Duration of a DB check")
+dbCommitTime = metrics.histogram("gardenpi_db_commit_seconds", "Duration of a DB commit")
 
 
-def db_init():
+def db_init(reloadAll=True):
     """
     Database file creation (if not present) and initialization.
+    With reloadAll every channel is marked for the DB thread to
+    send its configuration, otherwise the caller marks them.
     """
-    con = sqlite3.connect("gardenpi.sqlite")
+    con = storage.connect()
     cur = con.cursor()
+    cur.execute("BEGIN IMMEDIATE")
     cur.execute("CREATE TABLE IF NOT EXISTS configuration("
                 "channel INTEGER PRIMARY KEY,"
                 "enabled INTEGER,"
                 "period_s INTEGER,"
                 "duration_s INTEGER,"
                 "startTimeOfDay INTEGER,"
-                "updated INTEGER)")
+                "updated INTEGER,"
+                "extraStartTimes TEXT DEFAULT '',"
+                f"weekdays INTEGER DEFAULT {schedule.ALL_DAYS},"
+                "anchor INTEGER DEFAULT 0)")
+    # Add the columns introduced after the first release to older DB files
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(configuration)")]
+    if "extraStartTimes" not in columns:
+        cur.execute("ALTER TABLE configuration ADD COLUMN extraStartTimes TEXT DEFAULT ''")
+    if "weekdays" not in columns:
+        cur.execute("ALTER TABLE configuration ADD COLUMN weekdays INTEGER "
+                    f"DEFAULT {schedule.ALL_DAYS}")
+    # Local midnight the period of the channel counts from, see schedule
+    if "anchor" not in columns:
+        cur.execute("ALTER TABLE configuration ADD COLUMN anchor INTEGER DEFAULT 0")
+    # Installation wide settings, missing ones get their default value
+    cur.execute("CREATE TABLE IF NOT EXISTS settings("
+                "name TEXT PRIMARY KEY,"
+                "value INTEGER)")
+    cur.executemany("INSERT OR IGNORE INTO settings VALUES(?,?)", DEFAULT_SETTINGS.items())
+    channelCount = cur.execute("SELECT value FROM settings WHERE name='channelCount'").fetchone()[0]
     res = cur.execute("SELECT count(channel) FROM configuration")
     if res.fetchone()[0] == 0:
         logging.info("DB empty, creating default configuration")
-        res = cur.execute("INSERT INTO configuration VALUES(1,0,0,0,0,0),"
-                                                          "(2,0,0,0,0,0),"
-                                                          "(3,0,0,0,0,0),"
-                                                          "(4,0,0,0,0,0),"
-                                                          "(5,0,0,0,0,0),"
-                                                          "(6,0,0,0,0,0),"
-                                                          "(7,0,0,0,0,0),"
-                                                          "(8,0,0,0,0,0)")
-    cur.execute("UPDATE configuration set updated=1")
-    con.commit()
+    # Channels added by a larger channelCount start disabled
+    cur.executemany("INSERT OR IGNORE INTO configuration "
+                    "(channel,enabled,period_s,duration_s,startTimeOfDay,updated) "
+                    "VALUES(?,0,0,0,0,0)",
+                    [(channel,) for channel in range(1, channelCount + 1)])
+    cur.execute(storage.SET_MISSING_ANCHORS, (schedule.startOfDay(time.time()),))
+    # Relay of each channel, see gpios for the devices.
+    # Channels without a row get the standard wiring.
+    cur.execute("CREATE TABLE IF NOT EXISTS relays("
+                "channel INTEGER PRIMARY KEY,"
+                "device TEXT,"
+                "pin INTEGER,"
+                "activeLow INTEGER DEFAULT 1)")
+    cur.executemany("INSERT OR IGNORE INTO relays VALUES(?,?,?,?)",
+                    [(channel, device, pin, int(activeLow)) for channel, (device, pin, activeLow)
+                     in gpios.defaultRelayMap(channelCount).items()])
+    # Run history and its daily totals, days are local dates as YYYY-MM-DD
+    cur.execute("CREATE TABLE IF NOT EXISTS history("
+                "id INTEGER PRIMARY KEY,"
+                "channel INTEGER,"
+                "scheduledStart REAL,"
+                "actualStart REAL,"
+                "actualEnd REAL,"
+                "delay REAL,"
+                "litres REAL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS historyStart ON history(actualStart)")
+    cur.execute("CREATE INDEX IF NOT EXISTS historyChannelStart ON history(channel, actualStart)")
+    cur.execute("CREATE TABLE IF NOT EXISTS dailyUsage("
+                "day TEXT,"
+                "channel INTEGER,"
+                "runs INTEGER,"
+                "seconds REAL,"
+                "delaySeconds REAL,"
+                "litres REAL DEFAULT 0,"
+                "PRIMARY KEY(day, channel)) WITHOUT ROWID")
+    if "litres" not in [row[1] for row in cur.execute("PRAGMA table_info(history)")]:
+        cur.execute("ALTER TABLE history ADD COLUMN litres REAL")
+        cur.execute("ALTER TABLE dailyUsage ADD COLUMN litres REAL DEFAULT 0")
+    # Sensors and the rollups of their samples, see timeseries for
+    # the sources. Resolution and bucket are in seconds.
+    cur.execute("CREATE TABLE IF NOT EXISTS sensors("
+                "name TEXT PRIMARY KEY,"
+                "source TEXT,"
+                "scale REAL DEFAULT 1,"
+                "offset REAL DEFAULT 0,"
+                "unit TEXT DEFAULT '')")
+    cur.execute("CREATE TABLE IF NOT EXISTS sensorData("
+                "sensor TEXT,"
+                "resolution INTEGER,"
+                "bucket REAL,"
+                "count INTEGER,"
+                "total REAL,"
+                "minimum REAL,"
+                "maximum REAL,"
+                "PRIMARY KEY(sensor, resolution, bucket)) WITHOUT ROWID")
+    if reloadAll:
+        cur.execute("UPDATE configuration set updated=1")
+    cur.execute("COMMIT")
     con.close()
 
 
-class ChannelHandler(threading.Thread):
+def readSettings():
     # pylint: disable="invalid-name"
     """
-    GPIO channel handling thread.
-    This thread runs a queue for configuration
-    and handles the enabling and disabling of
-    a channel according to the received configuration.
+    Return the installation settings as a dict
     """
-    def __init__(self, ctrlChannel, displayThread, *args, **kwargs):
+    con = storage.connect()
+    res = dict(con.execute(storage.SELECT_SETTINGS).fetchall())
+    con.close()
+    return res
 
-        self.q = queue.Queue(maxsize=1)
-        self.displayThread = displayThread
+
+def readRelayMap(channelList):
+    # pylint: disable="invalid-name"
+    """
+    Return the relay map of the channels as a dict of
+    channel: (device, pin, activeLow)
+    """
+    con = storage.connect()
+    res = {}
+    for channel, device, pin, activeLow in con.execute(storage.SELECT_RELAYS):
+        if channel in channelList:
+            res[channel] = (device, pin, bool(activeLow))
+    con.close()
+    return res
+
+
+def readConfiguration():
+    # pylint: disable="invalid-name"
+    """
+    Return the configuration of every channel as a dict of
+    channel: configuration command
+    """
+    con = storage.connect()
+    res = {}
+    for row in con.execute(storage.SELECT_CONFIGURATION):
+        cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+        cmd.setConfig(row[0], row[1], row[2], row[3], row[4])
+        cmd.setSchedule(schedule.parseStartTimes(row[5]), row[6], row[7])
+        res[row[0]] = cmd
+    con.close()
+    return res
+
+
+def readSensorSources(flowMeter=None):
+    # pylint: disable="invalid-name"
+    """
+    Return the sources of the sensors as a dict of name: source.
+    The flow meter rate is recorded as flowRate unless a sensor
+    already reads it.
+    """
+    con = storage.connect()
+    rows = con.execute(storage.SELECT_SENSORS).fetchall()
+    con.close()
+    res = {}
+    for name, source, scale, offset in rows:
+        try:
+            res[name] = timeseries.sensorSource(source, scale, offset, flowMeter)
+        except (ValueError, TypeError):
+            logging.exception("Sensor %s not valid, ignored", name)
+    if flowMeter is not None and not any(source == "flow" for _, source, _, _ in rows):
+        res["flowRate"] = timeseries.FunctionSource(flowMeter.rate)
+    return res
+
+
+def markForReload(channels):
+    # pylint: disable="invalid-name"
+    """
+    Mark channels for the DB thread to send their configuration
+    """
+    con = storage.connect()
+    with storage.transaction(con):
+        con.executemany("UPDATE configuration set updated=1 WHERE channel=?",
+                        [(channel,) for channel in channels])
+    con.close()
+
+
+def displayDetected(bus=OLED_I2C_BUS, address=OLED_I2C_ADDRESS):
+    # pylint: disable="invalid-name"
+    """
+    Return True if a device answers on the OLED address.
+    The bus is probed through the kernel interface, so the
+    display modules are only loaded if there is a display.
+    """
+    try:
+        fd = os.open(f"/dev/i2c-{bus}", os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.ioctl(fd, I2C_SLAVE, address)
+        os.read(fd, 1)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def terminate(signum, frame):
+    # pylint: disable="unused-argument"
+    """
+    SIGTERM handler, systemctl stop and restart leave
+    through the same shutdown as a keyboard interrupt
+    """
+    raise KeyboardInterrupt("SIGTERM")
+
+
+def registerQueueMetrics(name, mailbox):
+    # pylint: disable="invalid-name"
+    """
+    Export the depth and message counters of a thread queue
+    """
+    labels = {"thread": name}
+    metrics.gauge("gardenpi_queue_depth", "Commands waiting in a thread queue",
+                  mailbox.qsize, labels)
+    for counter in ("received", "coalesced", "dropped"):
+        metrics.gauge(f"gardenpi_queue_{counter}_total", f"Commands {counter} by a thread queue",
+                      lambda counter=counter: mailbox.getStats()[counter], labels, kind="counter")
+
+
+class ChannelHandler():
+    # pylint: disable="invalid-name"
+    """
+    GPIO channel state.
+    Holds the configuration and run state of a single
+    channel and handles the enabling and disabling of
+    the channel according to the received configuration.
+    Channels don't run their own thread, the transitions
+    are driven by the SchedulerHandler.
+    """
+    # Installations can have over a hundred channels
+    __slots__ = ("channel", "planner", "enabled", "periodSeconds", "durationSeconds",
+                 "startTimeOfDay", "extraStartTimes", "weekdays", "anchor", "schedule",
+                 "nextStartTime", "nextEndTime", "startSlot", "delaySeconds",
+                 "actualStart", "resumeEnd", "history", "flowMeter", "running")
+    def __init__(self, ctrlChannel, actuationPlanner):
         self.channel = ctrlChannel
+        self.planner = actuationPlanner
         self.enabled = 0
         self.periodSeconds = 0
         self.durationSeconds = 0
         self.startTimeOfDay = 0
+        self.extraStartTimes = []
+        self.weekdays = schedule.ALL_DAYS
+        self.anchor = 0
+        self.schedule = None
         self.nextStartTime = 0
         self.nextEndTime = 0
+        # Start time given by the planner when the start is delayed
+        self.startSlot = 0
+        self.delaySeconds = 0
+        self.actualStart = 0
+        # End of a run interrupted by a restart, waiting to be resumed
+        self.resumeEnd = 0
+        # Run history recorder and flow meter, set by the scheduler
+        self.history = None
+        self.flowMeter = None
         self.running = queueCmd.CHANNEL_OFF
         gpios.channelSetOff(self.channel)
+
+    def statusCommand(self):
+        """
+        Build a configuration command reporting the current
+        status of the channel
+        """
+        cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+        cmd.setConfig(self.channel, self.enabled, self.periodSeconds,
+                      self.durationSeconds, self.startTimeOfDay)
+        cmd.setSchedule(self.extraStartTimes, self.weekdays, self.anchor)
+        if self.running == queueCmd.CHANNEL_ON:
+            cmd.addStatus(self.running, self.nextEndTime)
+        else:
+            cmd.addStatus(self.running, max(self.nextStartTime, self.startSlot))
+        cmd.setDelay(self.delaySeconds)
+        return cmd
+
+    def runState(self):
+        """
+        Return the run state of the channel as a runstate record
+        """
+        return (self.channel, queueCmd.CHANNEL_ON if self.resumeEnd else self.running,
+                runstate.configDigest(self.enabled, self.periodSeconds, self.durationSeconds,
+                                      self.startTimeOfDay, self.extraStartTimes, self.weekdays,
+                                      self.anchor),
+                self.nextStartTime, self.resumeEnd or self.nextEndTime,
+                self.actualStart, self.startSlot, self.delaySeconds)
+
+    def resume(self, cmd, record, currentTime):
+        """
+        Apply the configuration and the run state saved before
+        a restart. A run in progress is turned on again through
+        the planner and keeps its end time, a start still to
+        come is kept, with its slot if the planner delayed it.
+        Anything else is computed as for a new configuration.
+        """
+        _, state, _, nextStartTime, nextEndTime, actualStart, startSlot, delaySeconds = record
+        self.configure(cmd, currentTime)
+        if self.schedule is None:
+            return
+        if state == queueCmd.CHANNEL_ON and nextEndTime > currentTime:
+            logging.info("Channel %d resuming its run until %s", self.channel, time.ctime(nextEndTime))
+            self.nextStartTime = nextStartTime
+            self.startSlot = currentTime
+            self.resumeEnd = nextEndTime
+            self.actualStart = actualStart
+            self.delaySeconds = delaySeconds
+            self.running = queueCmd.CHANNEL_WAITING
+        elif state == queueCmd.CHANNEL_WAITING and max(nextStartTime, startSlot) > currentTime:
+            self.nextStartTime = nextStartTime
+            self.startSlot = startSlot
+            self.delaySeconds = delaySeconds
+
+    def recordRun(self, currentTime):
+        """
+        Record the run ending at currentTime in the history,
+        with its volume if there is a flow meter
+        """
+        litres = None
+        if self.flowMeter is not None:
+            litres = self.flowMeter.channelOff(self.channel)
+        if self.history is not None:
+            self.history.record(self.channel, self.nextStartTime, self.actualStart, currentTime,
+                                litres)
+
+    def nextDeadline(self):
+        """
+        Return the time of the next transition of the channel,
+        or None if the channel has nothing scheduled
+        """
+        if self.running == queueCmd.CHANNEL_WAITING:
+            return max(self.nextStartTime, self.startSlot)
+        if self.running == queueCmd.CHANNEL_ON:
+            return self.nextEndTime
+        return None
+
+    def configure(self, cmd, currentTime):
+        """
+        Apply a new configuration to the channel
+        """
+        self.enabled = cmd.getEnabled()
+        self.periodSeconds = cmd.getPeriod()
+        self.durationSeconds = cmd.getDuration()
+        self.startTimeOfDay = cmd.getStartTime()
+        self.extraStartTimes = cmd.getExtraStartTimes()
+        self.weekdays = cmd.getWeekdays()
+        self.anchor = cmd.getAnchor()
+        logging.info("Channel %d New Config. Enabled %d. Period %d. Duration %d. Start %d. "
+                     "Extra starts %s. Weekdays %02x. Anchor %d",
+                     self.channel,
+                     self.enabled,
+                     self.periodSeconds,
+                     self.durationSeconds,
+                     self.startTimeOfDay,
+                     self.extraStartTimes,
+                     self.weekdays,
+                     self.anchor)
+        if self.running == queueCmd.CHANNEL_ON:
+            gpios.channelSetOff(self.channel)
+            self.planner.close(self.channel)
+            self.recordRun(currentTime)
+        self.running = queueCmd.CHANNEL_OFF
+        self.startSlot = 0
+        self.delaySeconds = 0
+        self.resumeEnd = 0
+        self.schedule = None
+        if self.enabled == 1:
+            self.schedule = schedule.Schedule(self.periodSeconds, self.durationSeconds,
+                                              [self.startTimeOfDay] + self.extraStartTimes,
+                                              self.weekdays, self.anchor)
+            nextStartTime = self.schedule.nextStart(currentTime)
+            if nextStartTime is None:
+                logging.warning("Channel %d has no start times in its schedule", self.channel)
+            else:
+                self.nextStartTime = nextStartTime
+                self.running = queueCmd.CHANNEL_WAITING
+        else:
+            gpios.channelSetOff(self.channel)
+
+    def reanchor(self, delta, currentTime):
+        """
+        Move the channel to a new time base after the clock
+        jumped delta seconds. A run in progress keeps its
+        remaining duration, as does a start delayed by the
+        planner its slot. Other waiting channels recompute their
+        next start.
+        """
+        if self.schedule is None:
+            return
+        if self.running == queueCmd.CHANNEL_ON:
+            self.nextStartTime += delta
+            self.nextEndTime += delta
+            self.actualStart += delta
+        elif self.resumeEnd or self.startSlot:
+            self.nextStartTime += delta
+            self.startSlot += delta
+            if self.resumeEnd:
+                self.resumeEnd += delta
+                self.actualStart += delta
+        elif self.running == queueCmd.CHANNEL_WAITING:
+            self.startSlot = 0
+            nextStartTime = self.schedule.nextStart(currentTime)
+            if nextStartTime is None:
+                self.running = queueCmd.CHANNEL_OFF
+            else:
+                self.nextStartTime = nextStartTime
+
+    def transition(self, currentTime):
+        """
+        Turn the channel on or off if its next transition is due.
+        Returns True if the channel changed state
+        """
+        if self.running == queueCmd.CHANNEL_WAITING:
+            if currentTime >= max(self.nextStartTime, self.startSlot):
+                slot = self.planner.slot(currentTime)
+                if slot > currentTime:
+                    # Over budget, wait for the slot given by the planner
+                    changed = slot != self.startSlot
+                    self.startSlot = slot
+                    if not self.resumeEnd:
+                        self.delaySeconds = round(slot - self.nextStartTime)
+                    if changed:
+                        logging.info("Channel %d start delayed to %s",
+                                     self.channel, time.ctime(slot))
+                    return changed
+                deadline = max(self.nextStartTime, self.startSlot)
+                self.startSlot = 0
+                if self.resumeEnd:
+                    # Run interrupted by a restart, it ends when it was due to
+                    self.nextEndTime = self.resumeEnd
+                    self.resumeEnd = 0
+                    logging.info("Channel %d is on again. Ending at %s",
+                                 self.channel, time.ctime(self.nextEndTime))
+                else:
+                    self.delaySeconds = round(currentTime - self.nextStartTime)
+                    plannerDelay.observe(currentTime - self.nextStartTime)
+                    # The run gets its full duration even if it started late
+                    self.nextEndTime = currentTime + self.durationSeconds
+                    self.actualStart = currentTime
+                    logging.info("Channel %d is on. Ending at %s",
+                                 self.channel, time.ctime(self.nextEndTime))
+                gpios.channelSetOn(self.channel)
+                onLatency.observe(clock.now() - deadline)
+                if self.flowMeter is not None:
+                    self.flowMeter.channelOn(self.channel)
+                self.planner.open(self.channel, currentTime, self.nextEndTime)
+                self.running = queueCmd.CHANNEL_ON
+                return True
+        elif self.running == queueCmd.CHANNEL_ON:
+            if currentTime >= self.nextEndTime:
+                gpios.channelSetOff(self.channel)
+                offLatency.observe(clock.now() - self.nextEndTime)
+                self.planner.close(self.channel)
+                self.recordRun(currentTime)
+                self.delaySeconds = 0
+                # Starts that fell inside this run are skipped
+                nextStartTime = self.schedule.nextStart(max(currentTime, self.nextStartTime + 1))
+                if nextStartTime is None:
+                    logging.info("Channel %d is off", self.channel)
+                    self.running = queueCmd.CHANNEL_OFF
+                    return True
+                self.nextStartTime = nextStartTime
+                logging.info("Channel %d is off. Restarting at %s", self.channel, time.ctime(
+                    self.nextStartTime))
+                self.running = queueCmd.CHANNEL_WAITING
+                return True
+        return False
+
+
+class SchedulerHandler(threading.Thread):
+    # pylint: disable="invalid-name"
+    """
+    Channel scheduling thread.
+    This thread keeps a priority queue with the next
+    on/off transition of every channel and sleeps until
+    the earliest one is due or a new command arrives on
+    its queue. Configuration for all channels is received
+    through its queue. Turn-ons are planned within the power
+    budget given by maxOpen and minStagger. The display thread
+    is optional, None when running headless.
+    """
+    def __init__(self, channelList, displayThread=None, maxOpen=0, minStagger=1, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.q = queueCmd.Mailbox(queueCmd.MAILBOX_SIZE + len(channelList))
+        self.displayThread = displayThread
+        self.planner = planner.ActuationPlanner(maxOpen, minStagger)
+        self.statusWriter = None
+        self.eventBroadcaster = None
+        self.runStateStore = None
+        self.runStateChanged = False
+        self.channels = {}
+        for channel in channelList:
+            self.channels[channel] = ChannelHandler(channel, self.planner)
+        # Heap entries are (deadline, channel, generation). Entries
+        # whose generation doesn't match the channel's current one
+        # are stale and are discarded when popped.
+        self.heap = []
+        self.generation = {}
+        for channel in channelList:
+            self.generation[channel] = 0
         super().__init__(*args, **kwargs)
 
     def getQueue(self):
@@ -73,71 +579,185 @@ class ChannelHandler(threading.Thread):
         """
         return self.q
 
+    def getChannel(self, channel):
+        """
+        Return the channel state object for a channel number
+        """
+        return self.channels[channel]
+
+    def reschedule(self, channel):
+        """
+        Push the next deadline of a channel into the heap,
+        invalidating any previous entry for it
+        """
+        self.generation[channel] += 1
+        deadline = self.channels[channel].nextDeadline()
+        if deadline is not None:
+            heapq.heappush(self.heap, (deadline, channel, self.generation[channel]))
+
+    def nextDeadline(self):
+        """
+        Return the earliest pending deadline, or None if
+        no channel has anything scheduled
+        """
+        while self.heap:
+            deadline, channel, generation = self.heap[0]
+            if generation == self.generation[channel]:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def setStatusWriter(self, statusWriter):
+        """
+        Also publish the channel status to a shared snapshot
+        """
+        self.statusWriter = statusWriter
+
+    def setHistoryRecorder(self, historyRecorder):
+        """
+        Record the runs of every channel
+        """
+        for handler in self.channels.values():
+            handler.history = historyRecorder
+
+    def setFlowMeter(self, flowMeter):
+        """
+        Attribute the flow measured by a flow meter to the
+        channels that are on
+        """
+        for handler in self.channels.values():
+            handler.flowMeter = flowMeter
+
+    def setEventBroadcaster(self, eventBroadcaster):
+        """
+        Also send the channel status as events to the API server
+        """
+        self.eventBroadcaster = eventBroadcaster
+
+    def setRunStateStore(self, runStateStore):
+        """
+        Save the run state of the channels to a runstate store
+        every time it changes
+        """
+        self.runStateStore = runStateStore
+
+    def resume(self, records, configs, currentTime):
+        """
+        Restore the channels saved in runstate records whose
+        configuration is unchanged, given the configuration
+        commands by channel. Returns the channels restored.
+        """
+        resumed = []
+        for channel, record in records.items():
+            cmd = configs.get(channel)
+            if channel not in self.channels or cmd is None:
+                continue
+            digest = runstate.configDigest(cmd.getEnabled(), cmd.getPeriod(), cmd.getDuration(),
+                                           cmd.getStartTime(), cmd.getExtraStartTimes(),
+                                           cmd.getWeekdays(), cmd.getAnchor())
+            if digest != record[2]:
+                continue
+            self.channels[channel].resume(cmd, record, currentTime)
+            self.reschedule(channel)
+            self.publish(channel, events.EVENT_CONFIG)
+            resumed.append(channel)
+        return resumed
+
+    def saveRunState(self):
+        """
+        Save the run state if it changed since the last save
+        """
+        if self.runStateStore is not None and self.runStateChanged:
+            self.runStateChanged = False
+            self.runStateStore.save([handler.runState() for handler in self.channels.values()])
+
+    def publish(self, channel, event=events.EVENT_TRANSITION):
+        """
+        Send the status of a channel to the display thread,
+        to the shared snapshot and to the event subscribers.
+        event tells why the status is published.
+        """
+        cmd = self.channels[channel].statusCommand()
+        self.runStateChanged = True
+        if self.displayThread is not None:
+            self.displayThread.getQueue().put(cmd)
+        if self.statusWriter is not None:
+            handler = self.channels[channel]
+            self.statusWriter.update(channel, handler.enabled, handler.running,
+                                     handler.delaySeconds, handler.nextStartTime,
+                                     handler.nextEndTime, cmd.getNextTransition(),
+                                     clock.isSynchronized())
+        if self.eventBroadcaster is not None:
+            self.eventBroadcaster.publish(events.statusEvent(event, cmd, clock.now()))
+
+    def handleCommand(self, cmd, currentTime):
+        """
+        Process a command received on the thread queue.
+        Returns False if the thread must exit
+        """
+        if cmd.getType() == queueCmd.CMD_CHANNEL_CFG:
+            channel = cmd.getChannel()
+            if channel not in self.channels:
+                logging.error("Configuration for unknown channel %d", channel)
+                return True
+            self.channels[channel].configure(cmd, currentTime)
+            self.reschedule(channel)
+            self.publish(channel, events.EVENT_CONFIG)
+        elif cmd.getType() == queueCmd.CMD_TIME_SYNC:
+            delta = clock.setSynchronized()
+            currentTime = clock.now()
+            logging.info("Time synchronized, clock moved %.1f seconds", delta)
+            self.planner.shift(delta)
+            for channel, handler in self.channels.items():
+                handler.reanchor(delta, currentTime)
+                self.reschedule(channel)
+                self.publish(channel, events.EVENT_SYNC)
+        elif cmd.getType() == queueCmd.CMD_QUIT:
+            return False
+        return True
+
+    def runDue(self, currentTime):
+        """
+        Run every transition that is due at currentTime.
+        Relays switching together share the expander writes.
+        """
+        with gpios.batch():
+            while True:
+                deadline = self.nextDeadline()
+                if deadline is None or deadline > currentTime:
+                    return
+                _, channel, _ = heapq.heappop(self.heap)
+                if self.channels[channel].transition(currentTime):
+                    self.publish(channel)
+                self.reschedule(channel)
+
     def run(self):
         try:
-            logging.info("Channel %d thread starting", self.channel)
+            logging.info("Scheduler thread starting")
             while True:
+                deadline = self.nextDeadline()
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(0, deadline - clock.now())
                 try:
-                    cmd = self.q.get(block=True, timeout=1)
+                    cmd = self.q.get(block=True, timeout=timeout)
                     self.q.task_done()
-                    if cmd.getType() == queueCmd.CMD_CHANNEL_CFG:
-                        self.enabled = cmd.getEnabled()
-                        self.periodSeconds = cmd.getPeriod()
-                        self.durationSeconds = cmd.getDuration()
-                        self.startTimeOfDay = cmd.getStartTime()
-                        logging.info("Channel %d New Config. Enabled %d. Period %d. Duration %d. Start %d",
-                                     self.channel,
-                                     self.enabled,
-                                     self.periodSeconds,
-                                     self.durationSeconds,
-                                     self.startTimeOfDay)
-                        if self.enabled == 1:
-                            currentTime = time.time()
-                            gmt = time.localtime(currentTime)
-                            startOfDay = math.trunc(
-                                currentTime - ((gmt.tm_hour * 3600)+(gmt.tm_min*60)+gmt.tm_sec))
-                            self.nextStartTime = startOfDay + self.startTimeOfDay
-                            while self.nextStartTime < currentTime:
-                                self.nextStartTime += self.periodSeconds
-                            self.running = queueCmd.CHANNEL_WAITING
-                        else:
-                            gpios.channelSetOff(self.channel)
-                            self.running = queueCmd.CHANNEL_OFF
-                        cmd.addStatus(self.running, self.nextStartTime)
-                        self.displayThread.getQueue().put(cmd)
-                    elif cmd.getType() == queueCmd.CMD_QUIT:
-                        logging.info("Channel %d thread exiting", self.channel)
+                    running = self.handleCommand(cmd, clock.now())
+                    # A burst of configurations is saved once
+                    while running and not self.q.empty():
+                        cmd = self.q.get(block=False)
+                        self.q.task_done()
+                        running = self.handleCommand(cmd, clock.now())
+                    if not running:
+                        logging.info("Scheduler thread exiting")
                         return
                 except queue.Empty:
-                    currentTime = time.time()
-                    if self.running == queueCmd.CHANNEL_WAITING:
-                        if currentTime >= self.nextStartTime:
-                            self.nextEndTime = self.nextStartTime + self.durationSeconds
-                            logging.info("Channel %d is on. Ending at %s",
-                                         self.channel, time.ctime(self.nextEndTime))
-                            gpios.channelSetOn(self.channel)
-                            self.running = queueCmd.CHANNEL_ON
-                            cmd = queueCmd.QueueCommand(
-                                queueCmd.CMD_CHANNEL_CFG)
-                            cmd.setConfig(self.channel, self.enabled, self.periodSeconds,
-                                          self.durationSeconds, self.startTimeOfDay)
-                            cmd.addStatus(self.running, self.nextEndTime)
-                            self.displayThread.getQueue().put(cmd)
-                    if self.running == queueCmd.CHANNEL_ON:
-                        if currentTime >= self.nextEndTime:
-                            self.nextStartTime += self.periodSeconds
-                            logging.info("Channel %d is off. Restarting at %s", self.channel, time.ctime(
-                                self.nextStartTime))
-                            gpios.channelSetOff(self.channel)
-                            self.running = queueCmd.CHANNEL_WAITING
-                            cmd = queueCmd.QueueCommand(
-                                queueCmd.CMD_CHANNEL_CFG)
-                            cmd.setConfig(self.channel, self.enabled, self.periodSeconds,
-                                          self.durationSeconds, self.startTimeOfDay)
-                            cmd.addStatus(self.running, self.nextStartTime)
-                            self.displayThread.getQueue().put(cmd)
+                    pass
+                self.runDue(clock.now())
+                self.saveRunState()
         except Exception:  # pylint: disable="broad-exception-caught"
-            logging.exception("Exception on channel %d thread", self.channel)
+            logging.exception("Exception on scheduler thread")
             queueCmd.globalExit = True
             return
 
@@ -147,13 +767,24 @@ class DbHandler(threading.Thread):
     """ DB file handling thread.
        This thread monitors changes to the
        sqlite3 configuration file and refreshes
-       the configuration of the channel threads
+       the configuration of the scheduler thread
        when a change is detected. This is the only
        configuration entry point for the application.
+       Changes are signalled by the API server through
+       the notify socket. As a fallback for other writers
+       the DB data_version is polled, and the table is only
+       scanned when it reports a commit from another connection.
+       The buffered run history and sensor samples are
+       written by this thread too.
     """
-    def __init__(self, threadList, *args, **kwargs):
-        self.q = queue.Queue(maxsize=1)
-        self.threads = threadList
+    def __init__(self, schedulerThread, historyRecorder=None, sensorStore=None, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.q = queueCmd.Mailbox()
+        self.scheduler = schedulerThread
+        # Buffers written in batches, with flushDue() and flush(con)
+        self.buffers = [buffer for buffer in (historyRecorder, sensorStore) if buffer is not None]
+        self.listener = notify.ChangeListener()
+        self.dataVersion = None
         super().__init__(*args, **kwargs)
 
     def getQueue(self):
@@ -162,47 +793,173 @@ class DbHandler(threading.Thread):
         """
         return self.q
 
+    def wake(self):
+        """
+        Wake up the thread so it processes its queue
+        """
+        self.listener.wake()
+
+    def checkChanges(self, con, force):
+        """
+        Send the updated channel configurations to the scheduler
+        if the DB changed since the last check, or if forced
+        """
+        startTime = time.perf_counter()
+        version = storage.dataVersion(con)
+        if not force and version == self.dataVersion:
+            dbPollTime.observe(time.perf_counter() - startTime)
+            return
+        self.dataVersion = version
+        # The flags are read and cleared in one write transaction,
+        # otherwise a change committed in between would be cleared
+        # without being read. All the rows share a single commit.
+        with storage.transaction(con):
+            # Rows inserted by other writers don't set the anchor
+            con.execute(storage.SET_MISSING_ANCHORS, (schedule.startOfDay(clock.now()),))
+            config = con.execute(storage.SELECT_UPDATED).fetchall()
+            if config:
+                con.execute(storage.CLEAR_UPDATED)
+            commitTime = time.perf_counter()
+        dbCommitTime.observe(time.perf_counter() - commitTime)
+        for row in config:
+            cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+            chan = row[0]
+            cmd.setConfig(chan, row[1], row[2], row[3], row[4])
+            cmd.setSchedule(schedule.parseStartTimes(row[5]), row[6], row[7])
+            self.scheduler.getQueue().put(cmd)
+        dbPollTime.observe(time.perf_counter() - startTime)
+
+    def step(self, con, notified):
+        """
+        Check the DB for changes and write the buffers
+        that are due
+        """
+        self.checkChanges(con, notified)
+        for buffer in self.buffers:
+            if buffer.flushDue():
+                self.flush(con, buffer)
+
+    @staticmethod
+    def flush(con, buffer):
+        """
+        Write a buffer. A DB error is logged and the buffer
+        keeps its contents for the next attempt, the thread
+        goes on checking the configuration.
+        """
+        try:
+            buffer.flush(con)
+        except sqlite3.Error as error:
+            logging.warning("Can't write %s to the DB: %s", type(buffer).__name__, error)
+
+    def close(self, con):
+        """
+        Write the pending buffers and release the
+        connection and notification socket
+        """
+        try:
+            for buffer in self.buffers:
+                self.flush(con, buffer)
+        finally:
+            self.listener.close()
+            con.close()
+
     def run(self):
         try:
             logging.info("DB check thread starting")
-            con = sqlite3.connect("gardenpi.sqlite")
-            cur = con.cursor()
+            # Kept open for the life of the thread
+            con = storage.connect()
+            self.checkChanges(con, True)
             while True:
+                notified = self.listener.wait(DB_POLL_FALLBACK_S)
                 try:
-                    cmd = self.q.get(block=True, timeout=1)
+                    cmd = self.q.get(block=False)
                     self.q.task_done()
                     if cmd.getType() == queueCmd.CMD_QUIT:
                         logging.info("DB check thread exiting")
-                        con.close()
+                        self.close(con)
                         return
                 except queue.Empty:
-                    cur = con.cursor()
-                    res = cur.execute(
-                        "SELECT * from configuration WHERE updated=1")
-                    config = res.fetchall()
-                    for row in config:
-                        cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
-                        chan = row[0]
-                        cmd.setConfig(chan, row[1], row[2], row[3], row[4])
-                        self.threads[chan-1].getQueue().put(cmd)
-                        cur.execute(
-                            "UPDATE configuration set updated=0 WHERE channel=?", (chan,))
-                        con.commit()
+                    pass
+                self.step(con, notified)
         except Exception: # pylint: disable="broad-exception-caught"
             logging.exception("Exception on DB check thread")
+            self.listener.close()
             con.close()
             queueCmd.globalExit = True
             return
 
 
+class Supervisor():
+    # pylint: disable="invalid-name"
+    """
+    Work of the main thread: waits for the time to be
+    synchronized, saves the last known time hourly and pings
+    the systemd watchdog. The boot status is shown on the
+    display if there is one.
+    """
+    def __init__(self, wd, schedThread, ctrlThread):
+        self.wd = wd
+        self.schedThread = schedThread
+        self.ctrlThread = ctrlThread
+        self.retries = 0
+        self.timeSynced = False
+        self.lastSaved = None
+
+    def step(self):
+        """
+        Do one round of checks. Returns the seconds to wait
+        until the next one
+        """
+        if self.wd.is_enabled:
+            self.wd.ping()
+        if self.timeSynced:
+            # Saved once the scheduler has taken the time sync, then hourly
+            if clock.isSynchronized() and (self.lastSaved is None or
+                                           time.monotonic() - self.lastSaved >= SAVE_LAST_KNOWN_S):
+                clock.saveLastKnown()
+                self.lastSaved = time.monotonic()
+            return 60
+        networkUp = clock.networkReady()
+        timeValid = clock.timeSyncReady()
+        if timeValid:
+            logging.info("Time sync detected")
+            self.timeSynced = True
+            self.schedThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_TIME_SYNC))
+        elif self.retries == 300:
+            logging.warning("Running without time sync. Operation will be degraded")
+        if self.ctrlThread is not None:
+            if timeValid or self.retries == 300:
+                self.ctrlThread.bootDone()
+            elif self.retries < 300:
+                self.ctrlThread.setBootStatus(networkUp, timeValid)
+        self.retries += 1
+        return 1 if self.retries <= 300 else 60
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Garden irrigation controller")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the display, whatever the display setting")
+    args = parser.parse_args()
     logging.basicConfig(format="%(message)s", level=logging.INFO,
                         datefmt="%H:%M:%S")
     exitStatus = 0
+    # Anything can fail during startup, teardown only touches
+    # what was created and started
+    ctrlThread = None
+    schedThread = None
+    eventThread = None
+    dbThread = None
+    metricsThread = None
+    flowMeter = None
+    sensorThread = None
+    signal.signal(signal.SIGTERM, terminate)
     try:
         logging.info("Initializing configuration file")
-        db_init()
+        db_init(reloadAll=False)
 
+        # Only needed by the daemon, simulation.py imports this module off-Pi
+        import systemd_watchdog # pylint: disable="import-outside-toplevel"
         wd = systemd_watchdog.watchdog()
         if not wd.is_enabled:
             logging.warning("Systemd watchdog not detected")
@@ -213,68 +970,123 @@ if __name__ == "__main__":
         # can start
         wd.ready()
 
-        # We use a function from the display driver to display
-        # the boot screen. The function monitors the system to
-        # detect network and time sync status.
-        logging.info("Starting boot screen")
-        ctrlThread = control.DisplayHandler()
-        retries = 0
-        readyToStart = False
-        while not readyToStart and retries < 300:
-            readyToStart = ctrlThread.bootScreen()
-            time.sleep(1)
-            retries += 1
-            if wd.is_enabled:
-                wd.ping()
-
-        if not readyToStart:
-            logging.warn("Starting without time sync. Operation will be degraded")
-
-        # Wait as much as possible to configure GPIOs, to avoid
-        # any startup problems. Should not be needed since GPIOs
-        # are supposed to be kernel native, but doesn't hurt as
-        # they won't be used until we start the threads
-        logging.info("Configuring GPIO pins")
-        gpios.gpio_init()
+        # Scheduling starts right away. Until the time is synchronized
+        # the clock is estimated from the monotonic clock and the last
+        # known good time, and the next starts are recomputed once it is.
+        clock.init()
 
-        logging.info("Launching threads")
-        ctrlThread.daemon = True
-        ctrlThread.start()
+        settings = readSettings()
+        channelList = list(range(1, settings["channelCount"] + 1))
 
-        channelList = [1, 2, 3, 4, 5, 6, 7, 8]
-        thread_list = []
-        for channel in channelList:
-            thread_list.append(ChannelHandler(channel, ctrlThread))
-            thread_list[-1].daemon = True
-            thread_list[-1].start()
+        logging.info("Configuring GPIO pins for %d channels", len(channelList))
+        gpios.gpio_init(readRelayMap(channelList))
+
+        # The display modules are only loaded if there is a display.
+        # It shows the boot screen until the time is synchronized
+        if args.headless or settings["display"] == DISPLAY_NONE:
+            logging.info("Running headless")
+        elif settings["display"] == DISPLAY_DETECT and not displayDetected():
+            logging.info("No display detected, running headless")
+        else:
+            import control # pylint: disable="import-outside-toplevel"
+            ctrlThread = control.DisplayHandler(channelCount=len(channelList))
+        schedThread = SchedulerHandler(channelList, ctrlThread,
+                                       settings["maxOpenValves"], settings["minStaggerSeconds"])
+        # Live channel state for the API server
+        statusWriter = status.StatusWriter(channelList)
+        schedThread.setStatusWriter(statusWriter)
+        # Volume of each run, measured on the main line
+        if settings["flowMeter"]:
+            try:
+                flowMeter = flow.FlowMeter(flow.GpioChipPulseSource(),
+                                           settings["flowPulsesPerLitre"])
+            except OSError:
+                logging.exception("Can't open the flow meter line, running without it")
+        if flowMeter is not None:
+            schedThread.setFlowMeter(flowMeter)
+            flowMeter.setStatusWriter(statusWriter)
+            if ctrlThread is not None:
+                ctrlThread.setFlowMeter(flowMeter)
+        # State transitions and configuration changes for the API server stream
+        eventThread = events.EventBroadcaster()
+        schedThread.setEventBroadcaster(eventThread)
+        # Runs are buffered and written in batches by the DB thread
+        historyRecorder = history.HistoryRecorder()
+        schedThread.setHistoryRecorder(historyRecorder)
+        # Channels saved with their current configuration resume where
+        # they were, the others get their configuration from the DB thread
+        runStateStore = runstate.RunStateStore()
+        resumed = schedThread.resume(runStateStore.load(), readConfiguration(), clock.now())
+        if resumed:
+            logging.info("Resumed the run state of %d channels", len(resumed))
+        markForReload([channel for channel in channelList if channel not in resumed])
+        schedThread.setRunStateStore(runStateStore)
+        # Sensor samples are buffered and written as rollups by the DB thread
+        sensorStore = None
+        sensorSources = readSensorSources(flowMeter)
+        if sensorSources:
+            logging.info("Recording %d sensors", len(sensorSources))
+            sensorStore = timeseries.SensorStore()
+            sensorThread = timeseries.SensorSampler(sensorStore, sensorSources,
+                                                    settings["sensorIntervalSeconds"])
+        dbThread = DbHandler(schedThread, historyRecorder, sensorStore)
+        supervisor = Supervisor(wd, schedThread, ctrlThread)
 
-        dbThread = DbHandler(thread_list)
-        dbThread.daemon = True
-        dbThread.start()
+        if ctrlThread is not None:
+            registerQueueMetrics("display", ctrlThread.getQueue())
+        registerQueueMetrics("scheduler", schedThread.getQueue())
+        registerQueueMetrics("db", dbThread.getQueue())
+
+        logging.info("Launching threads")
+        for thread in (ctrlThread, eventThread, schedThread, dbThread, flowMeter,
+                       sensorThread):
+            if thread is not None:
+                thread.daemon = True
+                thread.start()
+        metricsThread = metrics.MetricsServer()
+        metricsThread.daemon = True
+        metricsThread.start()
 
         logging.info("Running")
-       
         wd.status("Running")
         while not queueCmd.globalExit:
-            time.sleep(60)
-            if wd.is_enabled:
-                wd.ping()
+            time.sleep(supervisor.step())
 
-    except KeyboardInterrupt:
-        logging.warning("Exiting due to keyboard interrupt")
+    except KeyboardInterrupt as interrupt:
+        logging.warning("Exiting due to %s", str(interrupt) or "keyboard interrupt")
     except Exception: # pylint: disable="broad-exception-caught"
         logging.exception("Exiting due to exception")
         exitStatus = 1
 
-    for channel in channelList:
-        thread_list[channel -
-                    1].getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
-        thread_list[channel-1].join(30)
-    ctrlThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
-    ctrlThread.join(30)
-    dbThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
-    dbThread.join(30)
+    # A second SIGTERM doesn't cut the shutdown short
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if schedThread is not None and schedThread.is_alive():
+        schedThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        schedThread.join(30)
+    if ctrlThread is not None and ctrlThread.is_alive():
+        ctrlThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        ctrlThread.join(30)
+    # The last samples are written by the DB thread on exit
+    if sensorThread is not None and sensorThread.is_alive():
+        sensorThread.stop()
+        sensorThread.join(30)
+    if dbThread is not None and dbThread.is_alive():
+        dbThread.getQueue().put(queueCmd.QueueCommand(queueCmd.CMD_QUIT))
+        dbThread.wake()
+        dbThread.join(30)
+    if metricsThread is not None:
+        metricsThread.stop()
+    if flowMeter is not None and flowMeter.is_alive():
+        flowMeter.stop()
+        flowMeter.join(30)
+    if eventThread is not None:
+        eventThread.stop()
+    if flowMeter is not None:
+        flowMeter.close()
 
-    gpios.gpio_end()
+    clock.saveLastKnown()
+    # Nothing to release if the GPIOs were never set up
+    if gpios.backend is not None:
+        gpios.gpio_end()
 
     sys.exit(exitStatus)
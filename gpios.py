@@ -1,10 +1,16 @@
 """
 gpios - module for initialization and control of the GPIOs used
-by the system. 
+by the system.
+The pins are driven through a backend object. The default backend
+uses RPi.GPIO, which is only imported when the backend is created,
+so the rest of the system can run off-Pi with another backend
+(see simulation.py).
+Relays are mapped to channels by a relay map, each channel is a
+pin of a device: "gpio" for the Pi GPIOs, or an I2C expander given
+as "mcp23017:<bus>:<address>". Expander writes are batched, a
+port is written once per batch() block.
 """
-import time
-import threading
-import RPi.GPIO as gpio
+import contextlib
 
 CH1_GPIO = 5
 CH2_GPIO = 6
@@ -20,47 +26,235 @@ DOWN_GPIO = 18
 SEL_GPIO = 15
 RST_GPIO = 23
 
+# Flow meter pulses, read through the GPIO character device (see flow.py)
+FLOW_GPIO = 17
+
+# Relays of the default map, channels 1 to 8
 relayGpios = [CH1_GPIO,CH2_GPIO,CH3_GPIO,CH4_GPIO,CH5_GPIO,CH6_GPIO,CH7_GPIO,CH8_GPIO]
 ctrlGpios = [UP_GPIO,DOWN_GPIO,SEL_GPIO,RST_GPIO]
 
-channelOnMutex = threading.Lock()
+# Channels past the Pi GPIOs default to MCP23017 expanders on I2C bus 1,
+# 16 relays each starting at address 0x20
+EXPANDER_BUS = 1
+EXPANDER_BASE_ADDRESS = 0x20
+EXPANDER_PINS = 16
+
+MCP23017_IODIRA = 0x00
+MCP23017_OLATA = 0x14
+
+class RpiGpioBackend():
+    # pylint: disable="invalid-name"
+    """
+    Backend driving the Raspberry Pi GPIOs with RPi.GPIO.
+    Relays are active low, buttons pull the input low.
+    """
+    def __init__(self):
+        import RPi.GPIO # pylint: disable="import-outside-toplevel"
+        self.gpio = RPi.GPIO
+    def setupOutputs(self, pins, initial):
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(pins, self.gpio.OUT, initial=self.gpio.HIGH if initial else self.gpio.LOW)
+    def setupInputs(self, pins):
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(pins, self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
+    def cleanup(self, pins):
+        self.gpio.cleanup(pins)
+    def output(self, pin, value):
+        self.gpio.output(pin, self.gpio.HIGH if value else self.gpio.LOW)
+    def input(self, pin):
+        return bool(self.gpio.input(pin))
+    def addFallingCallback(self, pin, callback_fn, bouncetime):
+        self.gpio.add_event_detect(pin, self.gpio.FALLING, callback=callback_fn, bouncetime=bouncetime)
+
+backend = None
+# channel: (driver, pin, activeLow)
+relays = {}
+drivers = {}
+_batching = False
+
+def setBackend(newBackend):
+    # pylint: disable="invalid-name,global-statement"
+    global backend
+    backend = newBackend
+
+def getBackend():
+    # pylint: disable="invalid-name"
+    if backend is None:
+        setBackend(RpiGpioBackend())
+    return backend
+
+class GpioRelays():
+    # pylint: disable="invalid-name"
+    """
+    Relays wired to the GPIOs of the backend
+    """
+    def __init__(self):
+        self.pins = []
+    def setup(self, levels):
+        for pin, level in levels.items():
+            getBackend().setupOutputs([pin], level)
+            self.pins.append(pin)
+    def set(self, pin, level):
+        getBackend().output(pin, level)
+    def flush(self):
+        pass
+    def close(self):
+        getBackend().cleanup(self.pins)
+
+
+class Mcp23017Relays():
+    # pylint: disable="invalid-name"
+    """
+    Relays on the 16 pins of an MCP23017 I2C expander.
+    Levels are kept in a copy of the output latches. Each write
+    is one bus transaction for a port, or for both ports when
+    both changed. Inside a batch the writes wait for flush().
+    """
+    def __init__(self, bus, address):
+        import smbus2 # pylint: disable="import-outside-toplevel"
+        self.bus = smbus2.SMBus(bus)
+        self.address = address
+        self.latch = [0xff, 0xff]
+        self.outputs = [0, 0]
+        self.offLevels = {}
+        self.dirty = set()
+    def setup(self, levels):
+        for pin, level in levels.items():
+            self.outputs[pin // 8] |= 1 << (pin % 8)
+            self.offLevels[pin] = level
+            self.setLatch(pin, level)
+        # The latches power up low, they are written before the
+        # pins become outputs so the relays never glitch on
+        self.dirty = {0, 1}
+        self.flush()
+        self.bus.write_i2c_block_data(self.address, MCP23017_IODIRA,
+                                      [0xff & ~self.outputs[0], 0xff & ~self.outputs[1]])
+    def setLatch(self, pin, level):
+        port = pin // 8
+        if level:
+            value = self.latch[port] | (1 << (pin % 8))
+        else:
+            value = self.latch[port] & ~(1 << (pin % 8))
+        if value != self.latch[port]:
+            self.latch[port] = value
+            self.dirty.add(port)
+    def set(self, pin, level):
+        self.setLatch(pin, level)
+        if not _batching:
+            self.flush()
+    def flush(self):
+        if len(self.dirty) == 2:
+            # Sequential addressing writes OLATA then OLATB
+            self.bus.write_i2c_block_data(self.address, MCP23017_OLATA, self.latch)
+        elif self.dirty:
+            port = self.dirty.pop()
+            self.bus.write_byte_data(self.address, MCP23017_OLATA + port, self.latch[port])
+        self.dirty.clear()
+    def close(self):
+        for pin, level in self.offLevels.items():
+            self.setLatch(pin, level)
+        self.flush()
+        self.bus.close()
+
+
+def relayDriver(device):
+    # pylint: disable="invalid-name"
+    """
+    Return the driver of a relay device, creating it on first use
+    """
+    if device not in drivers:
+        if device == "gpio":
+            drivers[device] = GpioRelays()
+        else:
+            kind, bus, address = device.split(":")
+            if kind != "mcp23017":
+                raise ValueError(f"Unknown relay device {device}")
+            drivers[device] = Mcp23017Relays(int(bus), int(address, 0))
+    return drivers[device]
+
+def defaultRelayMap(channelCount):
+    # pylint: disable="invalid-name"
+    """
+    Return the relay map of the standard wiring as a dict of
+    channel: (device, pin, activeLow)
+    """
+    relayMap = {}
+    for channel in range(1, channelCount + 1):
+        if channel <= len(relayGpios):
+            relayMap[channel] = ("gpio", relayGpios[channel - 1], True)
+        else:
+            index = channel - len(relayGpios) - 1
+            address = EXPANDER_BASE_ADDRESS + index // EXPANDER_PINS
+            relayMap[channel] = (f"mcp23017:{EXPANDER_BUS}:{address:#x}", index % EXPANDER_PINS, True)
+    return relayMap
+
+@contextlib.contextmanager
+def batch():
+    """
+    Group the relay changes of the block, each expander port is
+    written once at the end. Only used by the scheduler thread,
+    which is the only one switching relays.
+    """
+    # pylint: disable="global-statement"
+    global _batching
+    if _batching:
+        yield
+        return
+    _batching = True
+    try:
+        yield
+    finally:
+        _batching = False
+        for driver in drivers.values():
+            driver.flush()
 
-def gpio_init():
-    gpio.setmode(gpio.BCM)
-    gpio.setup(relayGpios, gpio.OUT, initial=gpio.HIGH)
-    gpio.setup(ctrlGpios, gpio.IN, pull_up_down=gpio.PUD_UP)
+def gpio_init(relayMap=None):
+    if relayMap is None:
+        relayMap = defaultRelayMap(len(relayGpios))
+    levels = {}
+    for channel, (device, pin, activeLow) in relayMap.items():
+        driver = relayDriver(device)
+        relays[channel] = (driver, pin, activeLow)
+        # Relays start off
+        levels.setdefault(device, {})[pin] = activeLow
+    for device, deviceLevels in levels.items():
+        relayDriver(device).setup(deviceLevels)
+    getBackend().setupInputs(ctrlGpios)
 
 def gpio_end():
-    gpio.cleanup(relayGpios)
-    gpio.cleanup(ctrlGpios)
+    for driver in drivers.values():
+        driver.close()
+    drivers.clear()
+    relays.clear()
+    getBackend().cleanup(ctrlGpios)
 
 def channelSetOn(channel):
-    # Use the mutex to keep channels from turning on
-    # simultaneously, to keep inrush current down
-    with channelOnMutex:
-        gpio.output(relayGpios[channel - 1],gpio.LOW)
-        time.sleep(1)
+    # Turn-ons are staggered by the actuation planner
+    # to keep inrush current down
+    driver, pin, activeLow = relays[channel]
+    driver.set(pin, not activeLow)
 
 def channelSetOff(channel):
-    gpio.output(relayGpios[channel - 1],gpio.HIGH)
+    driver, pin, activeLow = relays[channel]
+    driver.set(pin, activeLow)
 
 def upButtonPressed():
-    return not gpio.input(UP_GPIO)
+    return not getBackend().input(UP_GPIO)
 
 def downButtonPressed():
-    return not gpio.input(DOWN_GPIO)
+    return not getBackend().input(DOWN_GPIO)
 
 def selButtonPressed():
-    return not gpio.input(SEL_GPIO)
+    return not getBackend().input(SEL_GPIO)
 
 def rstButtonPressed():
-    return not gpio.input(RST_GPIO)
+    return not getBackend().input(RST_GPIO)
 
 def addUpButtonCallback(callback_fn):
-    gpio.add_event_detect(UP_GPIO, gpio.FALLING,callback=callback_fn, bouncetime=200)
+    getBackend().addFallingCallback(UP_GPIO, callback_fn, 200)
 
 def addDownButtonCallback(callback_fn):
-    gpio.add_event_detect(DOWN_GPIO, gpio.FALLING,callback=callback_fn, bouncetime=200)
+    getBackend().addFallingCallback(DOWN_GPIO, callback_fn, 200)
 
 def addSelButtonCallback(callback_fn):
-    gpio.add_event_detect(SEL_GPIO, gpio.FALLING,callback=callback_fn, bouncetime=200)
\ No newline at end of file
+    getBackend().addFallingCallback(SEL_GPIO, callback_fn, 200)
@@ -0,0 +1,102 @@
+"""
+history - Record of the watering runs.
+Finished runs are kept in memory and written in batches, so
+the SD card isn't written on every relay edge. A batch goes to
+the history table and is added to the daily totals in the same
+transaction, so usage queries over long ranges only read one
+row per channel and day. Runs still buffered are lost if the
+controller crashes, a clean exit writes them.
+"""
+import time
+import logging
+import threading
+import storage
+
+# A batch is written when this many runs are buffered,
+# or when the oldest one has waited FLUSH_INTERVAL_S
+FLUSH_RUNS = 32
+FLUSH_INTERVAL_S = 900
+# Oldest runs are dropped past this, if the DB can't be written
+MAX_BUFFERED = 1024
+
+
+def dayKey(timestamp):
+    # pylint: disable="invalid-name"
+    """
+    Return the local date of a timestamp as YYYY-MM-DD
+    """
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+
+class HistoryRecorder():
+    # pylint: disable="invalid-name"
+    """
+    Buffer of finished runs. record() is called by the
+    scheduler, flush() by the thread owning the DB connection.
+    """
+    def __init__(self, flushRuns=FLUSH_RUNS, flushInterval=FLUSH_INTERVAL_S):
+        self.flushRuns = flushRuns
+        self.flushInterval = flushInterval
+        self.lock = threading.Lock()
+        self.runs = []
+        self.oldest = None
+        self.dropped = 0
+
+    def record(self, channel, scheduledStart, actualStart, actualEnd, litres=None):
+        """
+        Buffer a finished run. litres is None if there is no
+        flow meter
+        """
+        with self.lock:
+            if len(self.runs) >= MAX_BUFFERED:
+                self.runs.pop(0)
+                self.dropped += 1
+            self.runs.append((channel, scheduledStart, actualStart, actualEnd,
+                              max(0, actualStart - scheduledStart), litres))
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def flushDue(self):
+        """
+        Return True if the buffered runs should be written
+        """
+        with self.lock:
+            return bool(self.runs) and (len(self.runs) >= self.flushRuns or
+                                        time.monotonic() - self.oldest >= self.flushInterval)
+
+    def restore(self, runs):
+        """
+        Put back in front the runs of a batch that couldn't be
+        written, they are retried with the next one
+        """
+        with self.lock:
+            self.runs = runs + self.runs
+            excess = len(self.runs) - MAX_BUFFERED
+            if excess > 0:
+                del self.runs[:excess]
+                self.dropped += excess
+            self.oldest = time.monotonic()
+
+    def flush(self, con):
+        """
+        Write the buffered runs in one transaction. The runs
+        are kept if the transaction fails.
+        Returns the number of runs written.
+        """
+        with self.lock:
+            runs = self.runs
+            self.runs = []
+            self.oldest = None
+        if not runs:
+            return 0
+        try:
+            with storage.transaction(con):
+                con.executemany(storage.INSERT_RUN, runs)
+                con.executemany(storage.ADD_DAILY_USAGE,
+                                [(dayKey(start), channel, end - start, delay, litres or 0)
+                                 for channel, _, start, end, delay, litres in runs])
+        except Exception:
+            self.restore(runs)
+            raise
+        logging.info("Wrote %d runs to the history", len(runs))
+        return len(runs)
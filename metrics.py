@@ -0,0 +1,216 @@
+"""
+metrics - Instrumentation counters and histograms of the
+controller, exported in the Prometheus text format.
+Updates only take a short lock and bisect the bucket bounds,
+so the instrumentation can stay on in production. The daemon
+serves the text on a local socket, the API server proxies it
+on /metrics.
+"""
+import bisect
+import socket
+import logging
+import threading
+
+# Linux abstract namespace socket, no file to clean up
+METRICS_ADDRESS = "\0gardenpi.metrics"
+
+# Bucket upper bounds in seconds, from 100us to 10s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Bucket upper bounds in seconds for planner delays, up to an hour
+DELAY_BUCKETS = (0, 1, 5, 15, 60, 300, 900, 3600)
+
+_lock = threading.Lock()
+_families = {}
+
+
+def _labelText(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class _Family():
+    # pylint: disable="too-few-public-methods"
+    def __init__(self, name, kind, description):
+        self.name = name
+        self.kind = kind
+        self.description = description
+        self.children = {}
+
+
+def _child(name, kind, description, labels, factory):
+    key = tuple(sorted(labels.items())) if labels else ()
+    with _lock:
+        family = _families.get(name)
+        if family is None:
+            family = _families[name] = _Family(name, kind, description)
+        child = family.children.get(key)
+        if child is None:
+            child = family.children[key] = factory()
+        return child
+
+
+class Counter():
+    # pylint: disable="invalid-name"
+    """
+    Monotonic counter
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+    def samples(self, name, labels):
+        return [f"{name}{_labelText(labels)} {self.value}"]
+
+
+class Gauge():
+    # pylint: disable="invalid-name"
+    """
+    Value read from a function when the metrics are exported
+    """
+    def __init__(self):
+        self.function = None
+    def samples(self, name, labels):
+        try:
+            value = self.function()
+        except Exception:  # pylint: disable="broad-exception-caught"
+            logging.exception("Can't read gauge %s", name)
+            return []
+        return [f"{name}{_labelText(labels)} {value}"]
+
+
+class Histogram():
+    # pylint: disable="invalid-name"
+    """
+    Distribution of observed values in fixed buckets
+    """
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        res = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            bucketLabels = labels + (("le", bound),)
+            res.append(f"{name}_bucket{_labelText(bucketLabels)} {cumulative}")
+        res.append(f"{name}_sum{_labelText(labels)} {total}")
+        res.append(f"{name}_count{_labelText(labels)} {cumulative}")
+        return res
+
+
+def counter(name, description, labels=None):
+    """
+    Return the counter with the given name and labels,
+    creating it on first use
+    """
+    return _child(name, "counter", description, labels, Counter)
+
+
+def gauge(name, description, function, labels=None, kind="gauge"):
+    """
+    Register a function read when the metrics are exported.
+    kind can be "counter" for functions returning a count.
+    """
+    child = _child(name, kind, description, labels, Gauge)
+    child.function = function
+    return child
+
+
+def histogram(name, description, labels=None, buckets=LATENCY_BUCKETS):
+    """
+    Return the histogram with the given name and labels,
+    creating it on first use
+    """
+    return _child(name, "histogram", description, labels,
+                  lambda: Histogram(tuple(buckets)))
+
+
+def exposition():
+    """
+    Return all the metrics in the Prometheus text format
+    """
+    with _lock:
+        families = [(family, list(family.children.items()))
+                    for family in _families.values()]
+    lines = []
+    for family, children in families:
+        lines.append(f"# HELP {family.name} {family.description}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+        for labels, child in children:
+            lines.extend(child.samples(family.name, labels))
+    return "\n".join(lines) + "\n"
+
+
+def read(address=METRICS_ADDRESS, timeout=2):
+    """
+    Return the metrics text served by the daemon
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    return b"".join(chunks).decode("utf-8")
+
+
+class MetricsServer(threading.Thread):
+    # pylint: disable="invalid-name"
+    """
+    Thread serving the metrics text to every connection
+    on a local socket, then closing it
+    """
+    def __init__(self, address=METRICS_ADDRESS, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        super().__init__(*args, **kwargs)
+
+    def stop(self):
+        """
+        Stop serving
+        """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def run(self):
+        try:
+            self.sock.bind(self.address)
+            self.sock.listen(4)
+        except OSError:
+            logging.warning("Can't bind metrics socket, metrics not served")
+            return
+        logging.info("Metrics thread starting")
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                logging.info("Metrics thread exiting")
+                return
+            with conn:
+                try:
+                    conn.settimeout(2)
+                    conn.sendall(exposition().encode("utf-8"))
+                except OSError:
+                    pass
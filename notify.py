@@ -0,0 +1,81 @@
+"""
+notify - Local change notifications between the API server
+and the controller daemon.
+The API sends a datagram to the controller every time it
+commits a configuration change, so the change is picked up
+right away instead of waiting for the next DB poll.
+"""
+import socket
+import select
+import logging
+import time
+
+# Linux abstract namespace socket, no file to clean up
+CONFIG_ADDRESS = "\0gardenpi.config"
+
+
+def notifyConfigChange(address=CONFIG_ADDRESS):
+    # pylint: disable="invalid-name"
+    """
+    Signal the controller that the configuration changed.
+    This is best effort: if the controller is not listening
+    the change will be found by its fallback poll.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(b"c", address)
+    except OSError:
+        pass
+
+
+class ChangeListener():
+    # pylint: disable="invalid-name"
+    """
+    Receiving end of the change notifications.
+    If the socket can't be bound the listener degrades
+    to a plain sleep and the caller relies on polling.
+    """
+    def __init__(self, address=CONFIG_ADDRESS):
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        try:
+            self.sock.bind(address)
+        except OSError:
+            logging.warning("Can't bind change notification socket, polling only")
+            self.sock.close()
+            self.sock = None
+
+    def wait(self, timeout):
+        """
+        Wait for a notification for up to timeout seconds.
+        Returns True if notified. Pending notifications are
+        drained, so a burst of changes wakes the caller once.
+        """
+        if self.sock is None:
+            time.sleep(timeout)
+            return False
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while True:
+                self.sock.recv(16)
+        except BlockingIOError:
+            pass
+        return True
+
+    def wake(self):
+        """
+        Wake up a thread blocked on wait()
+        """
+        notifyConfigChange(self.address)
+
+    def close(self):
+        """
+        Release the socket
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
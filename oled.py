@@ -0,0 +1,120 @@
+"""
+oled - Display layer on top of the Adafruit SSD1306 driver.
+It keeps a copy of the last frame sent to the display and
+only transfers the pages and column ranges that changed.
+Identical frames are not sent at all.
+"""
+from PIL import Image
+
+SSD1306_COLUMNADDR = 0x21
+SSD1306_PAGEADDR = 0x22
+
+# I2C control bytes for a command stream and for display RAM data
+I2C_COMMAND = 0x00
+I2C_DATA = 0x40
+# Maximum payload of an SMBus block write is 32 bytes, the
+# Adafruit driver uses 16 byte chunks as well
+I2C_CHUNK = 16
+
+_BIT_REVERSE = bytes(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+
+def pageBuffer(image):
+    # pylint: disable="invalid-name"
+    """
+    Convert a mode '1' image to the SSD1306 memory layout:
+    one byte per column for each 8 row page, top row in the
+    least significant bit. Done with PIL and bytes operations
+    instead of reading the pixels one by one.
+    """
+    pages = image.height // 8
+    data = image.transpose(Image.Transpose.TRANSPOSE).tobytes().translate(_BIT_REVERSE)
+    return b"".join(data[page::pages] for page in range(pages))
+
+
+class OledDisplay():
+    # pylint: disable="invalid-name"
+    """
+    Wrapper around an Adafruit SSD1306 object with the same
+    begin/clear/image/display interface.
+    """
+    def __init__(self, disp):
+        self.disp = disp
+        self.width = disp.width
+        self.height = disp.height
+        self.pages = disp.height // 8
+        self.frame = bytes(self.width * self.pages)
+        # Contents of the display RAM, None when unknown
+        self.shadow = None
+        self.framesSent = 0
+        self.framesSkipped = 0
+        self.bytesSent = 0
+
+    def begin(self):
+        """
+        Initialize the display. Its contents are unknown
+        until the next frame is sent.
+        """
+        self.disp.begin()
+        self.shadow = None
+
+    def clear(self):
+        """
+        Clear the frame to send
+        """
+        self.frame = bytes(self.width * self.pages)
+
+    def image(self, image):
+        """
+        Set the frame to send from a mode '1' image
+        """
+        self.frame = pageBuffer(image)
+
+    def sendRegion(self, firstPage, lastPage, first, last):
+        """
+        Send columns first to last of pages firstPage to
+        lastPage to the display
+        """
+        # pylint: disable="protected-access"
+        i2c = self.disp._i2c
+        data = b"".join(self.frame[page * self.width + first:page * self.width + last + 1]
+                        for page in range(firstPage, lastPage + 1))
+        i2c.writeList(I2C_COMMAND, [SSD1306_COLUMNADDR, first, last,
+                                    SSD1306_PAGEADDR, firstPage, lastPage])
+        for index in range(0, len(data), I2C_CHUNK):
+            i2c.writeList(I2C_DATA, list(data[index:index + I2C_CHUNK]))
+        self.bytesSent += len(data)
+
+    def display(self):
+        """
+        Send the parts of the frame that changed since the
+        last call to the display
+        """
+        frame = self.frame
+        if frame == self.shadow:
+            self.framesSkipped += 1
+            return
+        # pylint: disable="protected-access"
+        if self.disp._i2c is None:
+            # SPI displays get the whole frame through the driver
+            self.disp._buffer = list(frame)
+            self.disp.display()
+            self.bytesSent += len(frame)
+        elif self.shadow is None:
+            self.sendRegion(0, self.pages - 1, 0, self.width - 1)
+        else:
+            for page in range(self.pages):
+                start = page * self.width
+                new = frame[start:start + self.width]
+                old = self.shadow[start:start + self.width]
+                if new == old:
+                    continue
+                first = 0
+                while new[first] == old[first]:
+                    first += 1
+                last = self.width - 1
+                while new[last] == old[last]:
+                    last -= 1
+                self.sendRegion(page, page, first, last)
+        self.shadow = frame
+        self.framesSent += 1
@@ -0,0 +1,67 @@
+"""
+planner - Actuation planning under the power and flow budget
+of the installation.
+The budget is a maximum number of valves open at the same time
+and a minimum time between two valves turning on, which keeps
+the inrush current of the solenoids down. The planner never
+blocks, it returns the earliest time a run can start and the
+caller waits for that time like any other deadline. Runs always
+keep their full duration, so a delayed start delays the end.
+"""
+
+
+class ActuationPlanner():
+    # pylint: disable="invalid-name"
+    """
+    Book keeping of the valves open and of the last turn on.
+    A maxOpen of 0 means no limit on open valves.
+    """
+    def __init__(self, maxOpen=0, minStagger=1):
+        self.maxOpen = maxOpen
+        self.minStagger = minStagger
+        self.openRuns = {}
+        self.lastTurnOn = None
+
+    def slot(self, requested):
+        """
+        Return the earliest time at or after requested that
+        a run can start within the budget
+        """
+        start = requested
+        if self.lastTurnOn is not None:
+            start = max(start, self.lastTurnOn + self.minStagger)
+        if self.maxOpen > 0:
+            ends = sorted(end for end in self.openRuns.values() if end > start)
+            if len(ends) >= self.maxOpen:
+                # Wait until enough of the open valves close
+                start = ends[len(ends) - self.maxOpen]
+        return start
+
+    def open(self, channel, start, end):
+        """
+        Record a run starting
+        """
+        self.openRuns[channel] = end
+        self.lastTurnOn = start
+
+    def close(self, channel):
+        """
+        Record a run ending
+        """
+        self.openRuns.pop(channel, None)
+
+    def shift(self, delta):
+        """
+        Move the open runs to a new time base after the
+        clock jumped delta seconds
+        """
+        for channel in self.openRuns:
+            self.openRuns[channel] += delta
+        if self.lastTurnOn is not None:
+            self.lastTurnOn += delta
+
+    def openCount(self):
+        """
+        Return the number of valves open
+        """
+        return len(self.openRuns)
@@ -2,10 +2,19 @@
 queueCmd - definitions for thread communications
 and system state
 """
+import queue
+import threading
+import collections
+import schedule
 
 CMD_CHANNEL_CFG = 0
 CMD_WAKE_UP = 1
 CMD_QUIT = 2
+CMD_TIME_SYNC = 3
+CMD_BOOT_DONE = 4
+
+# Pending commands kept by a mailbox besides one per channel
+MAILBOX_SIZE = 64
 
 CHANNEL_OFF = 0
 CHANNEL_WAITING = 1
@@ -23,6 +32,10 @@ class QueueCommand():
        reporting. The type of action requested is defined
        by the type parameter
     """
+    # One is kept per channel by the display, keep them compact
+    __slots__ = ("type", "channel", "enabled", "periodSeconds", "durationSeconds",
+                 "startTimeOfDay", "extraStartTimes", "weekdays", "anchor", "state",
+                 "nextTransition", "delaySeconds")
     def __init__(self,cmdType):
         self.type = cmdType
         self.channel = 0
@@ -30,17 +43,27 @@ class QueueCommand():
         self.periodSeconds = 0
         self.durationSeconds = 0
         self.startTimeOfDay = 0
+        self.extraStartTimes = []
+        self.weekdays = schedule.ALL_DAYS
+        self.anchor = 0
         self.state = CHANNEL_OFF
         self.nextTransition = 0
+        self.delaySeconds = 0
     def setConfig(self,channel,enabled,period,duration,startTime):
         self.channel = channel
         self.enabled = enabled
         self.periodSeconds = period
         self.durationSeconds = duration
         self.startTimeOfDay = startTime
+    def setSchedule(self,extraStartTimes,weekdays,anchor=0):
+        self.extraStartTimes = extraStartTimes
+        self.weekdays = weekdays
+        self.anchor = anchor
     def addStatus(self,state,nextTransition):
         self.state = state
         self.nextTransition = nextTransition
+    def setDelay(self,delaySeconds):
+        self.delaySeconds = delaySeconds
     def getType(self):
         return self.type
     def getChannel(self):
@@ -53,8 +76,77 @@ class QueueCommand():
         return self.durationSeconds
     def getStartTime(self):
         return self.startTimeOfDay
+    def getExtraStartTimes(self):
+        return self.extraStartTimes
+    def getWeekdays(self):
+        return self.weekdays
+    def getAnchor(self):
+        return self.anchor
     def getState(self):
         return self.state
     def getNextTransition(self):
         return self.nextTransition
-    
\ No newline at end of file
+    def getDelay(self):
+        return self.delaySeconds
+
+
+class Mailbox():
+    # pylint: disable="invalid-name"
+    """
+       Thread command queue that never blocks the sender.
+       Pending commands are keyed by type and channel, and a
+       new command replaces the pending one with the same key,
+       so a new configuration supersedes a pending one for the
+       same channel and status updates coalesce to the latest
+       state. Commands are delivered in the order their key was
+       first queued. It has the get/put interface of queue.Queue.
+    """
+    def __init__(self, maxsize=MAILBOX_SIZE):
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+    def put(self, cmd, block=True, timeout=None):
+        # pylint: disable="unused-argument"
+        """
+        Queue a command. Never blocks, the arguments are
+        accepted for compatibility with queue.Queue
+        """
+        key = (cmd.getType(), cmd.getChannel())
+        with self.cond:
+            self.received += 1
+            if key in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.maxsize and cmd.getType() != CMD_QUIT:
+                self.dropped += 1
+                return
+            self.pending[key] = cmd
+            self.cond.notify()
+    def get(self, block=True, timeout=None):
+        """
+        Return the next command, raising queue.Empty if
+        there is none before the timeout
+        """
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.pending, timeout)
+            if not self.pending:
+                raise queue.Empty
+            return self.pending.popitem(last=False)[1]
+    def task_done(self):
+        """
+        Kept for compatibility with queue.Queue
+        """
+    def empty(self):
+        return not self.pending
+    def qsize(self):
+        return len(self.pending)
+    def getStats(self):
+        """
+        Return the message counters of the mailbox
+        """
+        with self.cond:
+            return {"depth": len(self.pending), "received": self.received,
+                    "coalesced": self.coalesced, "dropped": self.dropped}
@@ -0,0 +1,116 @@
+"""
+render - Text frame composition for the OLED screens.
+Rendered text lines are cached by text, position and highlight,
+and frames are composed by copying the cached line rows into a
+single reusable 1 bit per pixel buffer. A line is only drawn by
+PIL the first time it is shown, so its glyphs are placed exactly
+as PIL lays out the whole line.
+"""
+from PIL import Image
+from PIL import ImageDraw
+
+# Rows covered by a text line, matching the height of the
+# highlight bar the screens draw behind the selected line
+LINE_CELL = 11
+# Cached lines are dropped all at once when this many are stored
+LINE_CACHE_SIZE = 256
+
+PRINTABLE_CHARS = "".join(chr(code) for code in range(32, 127))
+
+_INVERT = [255 - value for value in range(256)]
+
+
+class TextRenderer():
+    # pylint: disable="invalid-name"
+    """
+    Composes screen frames from lines of text.
+    A frame is started with begin(), filled with text() and
+    hline() calls, and retrieved with image().
+    """
+    def __init__(self, font, width, height):
+        self.width = width
+        self.height = height
+        self.font = font
+        self.rowBytes = (width + 7) // 8
+        self.cellHeight = max(LINE_CELL, font.getbbox(PRINTABLE_CHARS)[3])
+        self.lines = {}
+        self.buffer = bytearray(self.rowBytes * height)
+        self.frameImage = None
+
+    def renderLine(self, x, text, inverted):
+        """
+        Draw a line of text, returning the rows of the line
+        packed 1 bit per pixel
+        """
+        strip = Image.new('1', (self.width, self.cellHeight))
+        ImageDraw.Draw(strip).text((x, 0), text, font=self.font, fill=255)
+        if inverted:
+            # Same as the highlight bar drawn with a black outline:
+            # black text on white, with black top, bottom and left edges
+            strip = strip.point(_INVERT)
+            draw = ImageDraw.Draw(strip)
+            draw.line([(0, 0), (self.width, 0)], fill=0)
+            draw.line([(0, LINE_CELL - 1), (self.width, LINE_CELL - 1)], fill=0)
+            draw.line([(0, 0), (0, LINE_CELL - 1)], fill=0)
+        return strip.tobytes()
+
+    def line(self, x, text, inverted):
+        """
+        Return a rendered line from the cache, rendering it
+        if needed
+        """
+        key = (x, text, inverted)
+        data = self.lines.get(key)
+        if data is None:
+            if len(self.lines) >= LINE_CACHE_SIZE:
+                self.lines.clear()
+            data = self.renderLine(x, text, inverted)
+            self.lines[key] = data
+        return data
+
+    def begin(self):
+        """
+        Start a new, blank frame
+        """
+        self.buffer[:] = bytes(len(self.buffer))
+        self.frameImage = None
+
+    def text(self, x, y, text, inverted=False):
+        """
+        Add a line of text to the frame with its top at row y.
+        Inverted lines are drawn black on a full width white bar
+        that covers whatever is below it, normal lines are merged
+        with the frame contents.
+        """
+        data = self.line(x, text, inverted)
+        rowBytes = self.rowBytes
+        # The highlight bar only covers LINE_CELL rows
+        rows = LINE_CELL if inverted else self.cellHeight
+        for row in range(rows):
+            frameRow = y + row
+            if frameRow < 0 or frameRow >= self.height:
+                continue
+            src = data[row * rowBytes:(row + 1) * rowBytes]
+            start = frameRow * rowBytes
+            dst = self.buffer[start:start + rowBytes]
+            if not inverted and any(dst):
+                src = (int.from_bytes(dst, "big") | int.from_bytes(src, "big")).to_bytes(rowBytes, "big")
+            self.buffer[start:start + rowBytes] = src
+        self.frameImage = None
+
+    def hline(self, y):
+        """
+        Add a full width horizontal line to the frame
+        """
+        if 0 <= y < self.height:
+            start = y * self.rowBytes
+            self.buffer[start:start + self.rowBytes] = b"\xff" * self.rowBytes
+            self.frameImage = None
+
+    def image(self):
+        """
+        Return the frame as a mode '1' image
+        """
+        if self.frameImage is None:
+            self.frameImage = Image.frombytes('1', (self.width, self.height), bytes(self.buffer))
+        return self.frameImage
@@ -0,0 +1,90 @@
+"""
+runstate - Run state of the channels kept across restarts.
+The scheduler saves the state of every channel when it changes,
+so a restarted controller resumes the runs in progress for their
+remaining time instead of switching them off and skipping them.
+The file has a fixed size record per channel. It is written under
+a temporary name and renamed into place, so a crash while saving
+leaves the previous state. Each record carries a digest of the
+configuration its times were computed from, a channel whose
+configuration no longer matches the DB starts afresh.
+"""
+import os
+import struct
+import hashlib
+import logging
+import time
+import schedule
+
+RUN_STATE_FILE = "gardenpi.runstate"
+
+MAGIC = b"GPRS"
+LAYOUT_VERSION = 2
+# magic, layout version, channel count, save time
+HEADER = struct.Struct("<4sIId")
+# channel, state, configuration digest, scheduled start, end,
+# actual start, start slot given by the planner, delay
+RECORD = struct.Struct("<HBx8sddddi")
+
+
+def configDigest(enabled, period, duration, startTime, extraStartTimes, weekdays, anchor=0):
+    # pylint: disable="invalid-name,too-many-arguments"
+    """
+    Return a short digest of a channel configuration
+    """
+    text = (f"{enabled}:{period}:{duration}:{startTime}:"
+            f"{schedule.formatStartTimes(extraStartTimes)}:{weekdays}:{anchor}")
+    return hashlib.blake2b(text.encode("ascii"), digest_size=8).digest()
+
+
+class RunStateStore():
+    # pylint: disable="invalid-name"
+    """
+    The run state file. Records are tuples in the RECORD
+    field order.
+    """
+    def __init__(self, path=RUN_STATE_FILE):
+        self.path = path
+
+    def save(self, records):
+        """
+        Replace the saved state with records
+        """
+        data = bytearray(HEADER.size + RECORD.size * len(records))
+        HEADER.pack_into(data, 0, MAGIC, LAYOUT_VERSION, len(records), time.time())
+        for index, record in enumerate(records):
+            RECORD.pack_into(data, HEADER.size + index * RECORD.size, *record)
+        tmpName = self.path + ".tmp"
+        fd = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmpName, self.path)
+
+    def load(self):
+        """
+        Return the saved records as a dict by channel, empty
+        if there is no valid saved state
+        """
+        try:
+            with open(self.path, "rb") as stateFile:
+                data = stateFile.read()
+        except FileNotFoundError:
+            return {}
+        except OSError:
+            logging.exception("Can't read the run state")
+            return {}
+        if len(data) < HEADER.size:
+            logging.warning("Run state file truncated, ignored")
+            return {}
+        magic, layout, count, _ = HEADER.unpack_from(data)
+        if magic != MAGIC or layout != LAYOUT_VERSION or len(data) != HEADER.size + RECORD.size * count:
+            logging.warning("Run state file not valid, ignored")
+            return {}
+        records = {}
+        for index in range(count):
+            record = RECORD.unpack_from(data, HEADER.size + index * RECORD.size)
+            records[record[0]] = record
+        return records
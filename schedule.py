@@ -0,0 +1,172 @@
+"""
+schedule - Computation of channel run times.
+
+A channel runs for its duration at each of its start times
+(seconds from local midnight). With a period of zero the start
+times repeat every day. Longer periods count from the anchor of
+the channel, the local midnight stored with its configuration:
+with a period that is a whole number of days the start times
+repeat on every Nth calendar day from the day of the anchor,
+any other period repeats them every period seconds from the
+anchor. The anchor is set when the period is configured, or
+given to choose the phase of the cycle, and the controller and
+the API server compute the same runs from it. In all cases
+starts falling on a weekday not enabled in the weekdays mask
+are skipped.
+
+All calculations are closed form, so the cost of finding the
+next run doesn't depend on how long ago the schedule started.
+"""
+import time
+import datetime
+import heapq
+import threading
+
+ALL_DAYS = 0x7f
+DAY_SECONDS = 24 * 3600
+
+# tm_wday order, Monday is bit 0
+WEEKDAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+_dayCache = (0, 0)
+_dayCacheLock = threading.Lock()
+
+
+def _midnight(timestamp, dayOffset=0):
+    # pylint: disable="invalid-name"
+    tm = time.localtime(timestamp)
+    return int(time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + dayOffset,
+                            0, 0, 0, 0, 0, -1)))
+
+
+def startOfDay(timestamp):
+    # pylint: disable="invalid-name"
+    """
+    Return the Unix time of the local midnight starting the
+    day that contains timestamp. The current day is cached,
+    so repeated calls during the same day are cheap.
+    """
+    global _dayCache # pylint: disable="global-statement"
+    dayStart, dayEnd = _dayCache
+    if dayStart <= timestamp < dayEnd:
+        return dayStart
+    dayStart = _midnight(timestamp)
+    with _dayCacheLock:
+        _dayCache = (dayStart, _midnight(timestamp, 1))
+    return dayStart
+
+
+def nextDayStart(timestamp):
+    # pylint: disable="invalid-name"
+    """
+    Return the Unix time of the local midnight following timestamp
+    """
+    return _midnight(timestamp, 1)
+
+
+def parseStartTimes(text):
+    # pylint: disable="invalid-name"
+    """
+    Convert the comma separated list of start times stored
+    in the DB into a list of integers
+    """
+    if not text:
+        return []
+    return [int(item) for item in str(text).split(",") if item.strip() != ""]
+
+
+def formatStartTimes(startTimes):
+    # pylint: disable="invalid-name"
+    """
+    Convert a list of start times into its DB representation
+    """
+    return ",".join(str(int(item)) for item in startTimes)
+
+
+class Schedule():
+    # pylint: disable="invalid-name"
+    """
+    Run times of a single channel
+    """
+    __slots__ = ("period", "duration", "startTimes", "weekdays", "anchor", "anchorDay", "periodDays")
+    def __init__(self, period, duration, startTimes, weekdays=ALL_DAYS, anchor=0):
+        self.period = period
+        self.duration = duration
+        self.startTimes = sorted(set(startTimes))
+        self.weekdays = weekdays & ALL_DAYS
+        self.anchor = anchor
+        self.anchorDay = datetime.date.fromtimestamp(anchor).toordinal()
+        if period <= 0:
+            self.periodDays = 1
+        elif period % DAY_SECONDS == 0:
+            self.periodDays = period // DAY_SECONDS
+        else:
+            self.periodDays = 0
+
+    def _nextUnfiltered(self, currentTime):
+        if self.periodDays == 0:
+            nextTime = None
+            for offset in self.startTimes:
+                first = self.anchor + offset
+                if first < currentTime:
+                    first += -(-(currentTime - first) // self.period) * self.period
+                if nextTime is None or first < nextTime:
+                    nextTime = first
+            return nextTime
+        day = datetime.date.fromtimestamp(currentTime).toordinal()
+        skipDays = (self.anchorDay - day) % self.periodDays
+        if skipDays == 0:
+            dayStart = startOfDay(currentTime)
+            for offset in self.startTimes:
+                if dayStart + offset >= currentTime:
+                    return dayStart + offset
+            skipDays = self.periodDays
+        return _midnight(currentTime, skipDays) + self.startTimes[0]
+
+    def nextStart(self, currentTime):
+        """
+        Return the first start time at or after currentTime,
+        or None if the schedule never runs
+        """
+        if not self.startTimes or self.weekdays == 0:
+            return None
+        searchTime = currentTime
+        # A start on a disabled day moves the search to the next
+        # midnight, so a week is always enough to find one
+        for _ in range(8):
+            candidate = self._nextUnfiltered(searchTime)
+            if self.weekdays & (1 << time.localtime(candidate).tm_wday):
+                return candidate
+            searchTime = nextDayStart(candidate)
+        return None
+
+    def runs(self, currentTime, count):
+        """
+        Return the next count runs as (start, end) tuples
+        """
+        res = []
+        searchTime = currentTime
+        while len(res) < count:
+            start = self.nextStart(searchTime)
+            if start is None:
+                break
+            res.append((start, start + self.duration))
+            searchTime = start + 1
+        return res
+
+
+def nextRuns(schedules, currentTime, count):
+    # pylint: disable="invalid-name"
+    """
+    Return the next count runs across a dict of schedules keyed
+    by channel, as (start, end, channel) tuples in start order
+    """
+    streams = []
+    for channel, sched in schedules.items():
+        streams.append([(start, end, channel) for start, end in sched.runs(currentTime, count)])
+    res = []
+    for run in heapq.merge(*streams):
+        res.append(run)
+        if len(res) == count:
+            break
+    return res
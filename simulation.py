@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+"""
+simulation - Simulated hardware running against a virtual clock.
+The GPIO backend records every relay edge with its virtual time
+and the display keeps its frames in memory. The Simulator drives
+the real scheduler and display handler step by step, jumping the
+virtual clock from one deadline to the next, so weeks of schedules
+replay in seconds.
+
+With zone flows, a simulated flow meter gives pulses at the sum
+of the flows of the channels on, and the volume of each run is
+measured as on the real meter.
+
+Usage: simulation.py [--db gardenpi.sqlite] [--days 28]
+                     [--max-open N] [--stagger S] [--flow L/min]
+Replays the configuration in the DB and prints a JSON summary.
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+from PIL import Image
+import gpios
+import clock
+import oled
+import control
+import queueCmd
+import schedule
+import gardenpi
+import storage
+import flow
+
+# Virtual GPIOs of the channels past the standard wiring
+SIM_PIN_BASE = 1000
+
+class SimClock():
+    # pylint: disable="invalid-name"
+    """
+    Virtual wall clock that only moves when told to
+    """
+    def __init__(self, startTime):
+        self.currentTime = startTime
+    def now(self):
+        return self.currentTime
+    def set(self, newTime):
+        self.currentTime = newTime
+    def advance(self, seconds):
+        self.currentTime += seconds
+
+
+class SimGpioBackend():
+    # pylint: disable="invalid-name"
+    """
+    GPIO backend keeping the pin levels in memory and recording
+    every output edge as (time, pin, level)
+    """
+    def __init__(self, simClock):
+        self.clock = simClock
+        self.levels = {}
+        self.edges = []
+        self.callbacks = {}
+    def setupOutputs(self, pins, initial):
+        for pin in pins:
+            self.levels[pin] = initial
+    def setupInputs(self, pins):
+        for pin in pins:
+            self.levels[pin] = True
+    def cleanup(self, pins):
+        pass
+    def output(self, pin, value):
+        if self.levels.get(pin) != value:
+            self.edges.append((self.clock.now(), pin, value))
+            self.levels[pin] = value
+    def input(self, pin):
+        return self.levels.get(pin, True)
+    def addFallingCallback(self, pin, callback_fn, bouncetime):
+        # pylint: disable="unused-argument"
+        self.callbacks[pin] = callback_fn
+    def press(self, pin):
+        """
+        Simulate a button press on an input pin
+        """
+        self.levels[pin] = False
+        if pin in self.callbacks:
+            self.callbacks[pin](pin)
+        self.levels[pin] = True
+    def relayRuns(self):
+        """
+        Return the relay on periods as (channel, start, end)
+        tuples. Relays are active low, end is None for a relay
+        still on.
+        """
+        runs = []
+        onSince = {}
+        channels = {pin: channel for channel, (_, pin, _) in gpios.relays.items()}
+        for edgeTime, pin, value in self.edges:
+            if pin not in channels:
+                continue
+            channel = channels[pin]
+            if not value:
+                onSince[channel] = edgeTime
+            elif channel in onSince:
+                runs.append((channel, onSince.pop(channel), edgeTime))
+        for channel, start in onSince.items():
+            runs.append((channel, start, None))
+        return sorted(runs, key=lambda run: run[1])
+
+
+class SimDisplay():
+    # pylint: disable="invalid-name"
+    """
+    Display with the begin/clear/image/display interface that
+    keeps the last frame shown in memory, in the SSD1306 layout
+    """
+    def __init__(self, width=128, height=64):
+        self.width = width
+        self.height = height
+        self.buffer = bytes(width * height // 8)
+        self.frame = self.buffer
+        self.framesShown = 0
+    def begin(self):
+        pass
+    def clear(self):
+        self.buffer = bytes(self.width * self.height // 8)
+    def image(self, image):
+        self.buffer = oled.pageBuffer(image)
+    def display(self):
+        self.frame = self.buffer
+        self.framesShown += 1
+    def toImage(self):
+        """
+        Return the frame shown as a mode '1' image
+        """
+        image = Image.new('1', (self.width, self.height))
+        pixels = image.load()
+        for page in range(self.height // 8):
+            for x in range(self.width):
+                bits = self.frame[page * self.width + x]
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        pixels[x, page * 8 + bit] = 255
+        return image
+
+
+def simRelayMap(channelList):
+    # pylint: disable="invalid-name"
+    """
+    Return a relay map with every channel on a GPIO of the
+    simulated backend. Channels past the standard wiring get
+    virtual pins instead of expander pins.
+    """
+    standard = gpios.defaultRelayMap(len(gpios.relayGpios))
+    relayMap = {}
+    for channel in channelList:
+        relayMap[channel] = standard.get(channel, ("gpio", SIM_PIN_BASE + channel, True))
+    return relayMap
+
+
+class Simulator():
+    # pylint: disable="invalid-name"
+    """
+    Runs the scheduler and display handler on simulated
+    hardware and a virtual clock. Nothing runs in its own
+    thread, runUntil() processes every deadline in order.
+    zoneFlows gives the litres per minute of each channel when on,
+    to measure the runs with a simulated flow meter.
+    """
+    def __init__(self, channelList, maxOpen=0, minStagger=1, startTime=None, zoneFlows=None):
+        # pylint: disable="too-many-arguments"
+        self.clock = SimClock(time.time() if startTime is None else startTime)
+        clock.setTimeSource(self.clock.now)
+        self.gpio = SimGpioBackend(self.clock)
+        gpios.setBackend(self.gpio)
+        gpios.gpio_init(simRelayMap(channelList))
+        self.display = SimDisplay()
+        self.displayHandler = control.DisplayHandler(self.display, max(channelList))
+        self.displayHandler.state = control.STATE_CHANNEL_SEL
+        self.displayHandler.startLine = 1
+        self.displayHandler.currentLine = 1
+        self.scheduler = gardenpi.SchedulerHandler(channelList, self.displayHandler,
+                                                   maxOpen, minStagger)
+        self.zoneFlows = zoneFlows
+        self.flowMeter = None
+        if zoneFlows is not None:
+            self.pulses = flow.SimPulseSource(timeSource=self.clock.now)
+            self.flowMeter = flow.FlowMeter(self.pulses)
+            self.scheduler.setFlowMeter(self.flowMeter)
+            self.displayHandler.setFlowMeter(self.flowMeter)
+        self.maxDelay = {}
+        self.maxOpen = 0
+
+    def close(self):
+        """
+        Restore the system clock
+        """
+        clock.setTimeSource(None)
+        if self.flowMeter is not None:
+            self.flowMeter.close()
+
+    def configure(self, cmd):
+        """
+        Send a channel configuration command to the scheduler
+        """
+        self.scheduler.handleCommand(cmd, self.clock.now())
+        self.drainDisplay()
+
+    def drainDisplay(self):
+        """
+        Process the status updates sent to the display and
+        render the screen if they changed it
+        """
+        displayQueue = self.displayHandler.getQueue()
+        while not displayQueue.empty():
+            cmd = displayQueue.get(block=False)
+            if cmd.getType() == queueCmd.CMD_CHANNEL_CFG and cmd.getState() == queueCmd.CHANNEL_ON:
+                channel = cmd.getChannel()
+                self.maxDelay[channel] = max(self.maxDelay.get(channel, 0), cmd.getDelay())
+            self.displayHandler.handleCommand(cmd)
+        if self.displayHandler.dirty:
+            self.displayHandler.screenStateMachine()
+
+    def runUntil(self, endTime):
+        """
+        Advance the virtual clock to endTime, running every
+        transition due on the way
+        """
+        while True:
+            deadline = self.scheduler.nextDeadline()
+            if deadline is None or deadline > endTime:
+                break
+            self.clock.set(max(deadline, self.clock.now()))
+            self.scheduler.runDue(self.clock.now())
+            self.maxOpen = max(self.maxOpen, self.scheduler.planner.openCount())
+            self.updateFlow()
+            self.drainDisplay()
+        self.clock.set(max(endTime, self.clock.now()))
+
+    def updateFlow(self):
+        """
+        Set the simulated meter to the flow of the channels on.
+        The meter collects the pulses at every transition, so
+        those at the previous flow are counted already.
+        """
+        if self.flowMeter is None:
+            return
+        _, _, openChannels = self.flowMeter.volumes()
+        self.pulses.setFlow(sum(self.zoneFlows.get(channel, 0) for channel in openChannels))
+
+    def summary(self):
+        """
+        Return the runs and delays seen so far per channel
+        """
+        channels = {}
+        for channel, start, end in self.gpio.relayRuns():
+            stats = channels.setdefault(channel, {"runs": 0, "onSeconds": 0, "maxDelay": 0})
+            stats["runs"] += 1
+            stats["onSeconds"] += (self.clock.now() if end is None else end) - start
+            stats["maxDelay"] = self.maxDelay.get(channel, 0)
+        if self.flowMeter is not None:
+            self.flowMeter.step()
+            _, totalLitres, _ = self.flowMeter.volumes()
+            for channel, stats in channels.items():
+                stats["litres"] = round(totalLitres.get(channel, 0), 3)
+        return {"relayEdges": len(self.gpio.edges),
+                "framesShown": self.display.framesShown,
+                "maxOpenValves": self.maxOpen,
+                "channels": dict(sorted(channels.items()))}
+
+
+def loadConfiguration(dbName):
+    # pylint: disable="invalid-name"
+    """
+    Return the channel configuration commands stored in a DB
+    """
+    con = storage.connect(dbName)
+    res = con.execute(storage.SELECT_CONFIGURATION).fetchall()
+    con.close()
+    commands = []
+    for row in res:
+        cmd = queueCmd.QueueCommand(queueCmd.CMD_CHANNEL_CFG)
+        cmd.setConfig(row[0], row[1], row[2], row[3], row[4])
+        cmd.setSchedule(schedule.parseStartTimes(row[5]), row[6], row[7])
+        commands.append(cmd)
+    return commands
+
+
+def main():
+    # pylint: disable="invalid-name"
+    """
+    Replay the DB configuration and print a summary
+    """
+    parser = argparse.ArgumentParser(description="Replay gardenpi schedules on simulated hardware")
+    parser.add_argument("--db", default=storage.DB_NAME)
+    parser.add_argument("--days", type=float, default=28)
+    parser.add_argument("--max-open", type=int, default=0)
+    parser.add_argument("--stagger", type=float, default=1)
+    parser.add_argument("--flow", type=float, default=None,
+                        help="litres per minute of every zone, to simulate a flow meter")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+
+    commands = loadConfiguration(args.db)
+    channelList = [cmd.getChannel() for cmd in commands]
+    zoneFlows = None
+    if args.flow is not None:
+        zoneFlows = {channel: args.flow for channel in channelList}
+    sim = Simulator(channelList, args.max_open, args.stagger, zoneFlows=zoneFlows)
+    startTime = sim.clock.now()
+    for cmd in commands:
+        sim.configure(cmd)
+    wallStart = time.perf_counter()
+    sim.runUntil(startTime + args.days * schedule.DAY_SECONDS)
+    res = sim.summary()
+    res["simulatedDays"] = args.days
+    res["wallSeconds"] = time.perf_counter() - wallStart
+    sim.close()
+    json.dump(res, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+status - Live channel state shared between the controller
+and the API server through a memory mapped file.
+The controller is the only writer, its threads take turns
+through a lock. Every update is wrapped in a sequence counter that is odd while the update is in
+progress (a seqlock), so readers never take a lock and never
+make a request to the controller: they copy the snapshot and
+retry if the counter was odd or changed during the copy.
+The counter divided by two is the version of the snapshot.
+"""
+import os
+import mmap
+import time
+import struct
+import tempfile
+import threading
+import queueCmd
+
+STATUS_FILE = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                           "gardenpi.status")
+
+MAGIC = b"GPST"
+LAYOUT_VERSION = 3
+# magic, layout version, sequence, channel count, flags, update time,
+# flow in litres per minute
+HEADER = struct.Struct("<4sIQIIdd")
+SEQ_OFFSET = 8
+FLOW_OFFSET = 32
+# channel, enabled, state, delay, next start, next end, next transition,
+# litres of the current or last run
+RECORD = struct.Struct("<HBBidddd")
+LITRES_OFFSET = RECORD.size - 8
+FLAG_SYNCHRONIZED = 1
+
+READ_RETRIES = 100
+
+STATE_NAMES = {queueCmd.CHANNEL_OFF: "off",
+               queueCmd.CHANNEL_WAITING: "waiting",
+               queueCmd.CHANNEL_ON: "on"}
+
+
+class StatusWriter():
+    # pylint: disable="invalid-name"
+    """
+    Controller side of the snapshot. The file is initialized
+    under a temporary name and renamed into place, so readers
+    never map a partial file.
+    """
+    def __init__(self, channelList, path=STATUS_FILE):
+        self.index = {}
+        for index, channel in enumerate(channelList):
+            self.index[channel] = index
+        self.size = HEADER.size + RECORD.size * len(channelList)
+        tmpName = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmpName, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.litres = {}
+        HEADER.pack_into(self.map, 0, MAGIC, LAYOUT_VERSION, self.seq, len(channelList), 0,
+                         time.time(), 0)
+        for channel, index in self.index.items():
+            RECORD.pack_into(self.map, HEADER.size + index * RECORD.size,
+                             channel, 0, queueCmd.CHANNEL_OFF, 0, 0, 0, 0, 0)
+        os.replace(tmpName, path)
+
+    def update(self, channel, enabled, state, delaySeconds, nextStartTime,
+               nextEndTime, nextTransition, synchronized):
+        """
+        Publish the state of a channel
+        """
+        with self.lock:
+            self.seq += 1
+            struct.pack_into("<Q", self.map, SEQ_OFFSET, self.seq)
+            RECORD.pack_into(self.map, HEADER.size + self.index[channel] * RECORD.size,
+                             channel, enabled, state, delaySeconds,
+                             nextStartTime, nextEndTime, nextTransition,
+                             self.litres.get(channel, 0))
+            struct.pack_into("<Id", self.map, SEQ_OFFSET + 12,
+                             FLAG_SYNCHRONIZED if synchronized else 0, time.time())
+            self.seq += 1
+            struct.pack_into("<Q", self.map, SEQ_OFFSET, self.seq)
+
+    def updateFlow(self, litresPerMinute, runLitres):
+        """
+        Publish the flow and the run volumes, a dict of
+        channel: litres
+        """
+        with self.lock:
+            self.litres.update(runLitres)
+            self.seq += 1
+            struct.pack_into("<Q", self.map, SEQ_OFFSET, self.seq)
+            struct.pack_into("<d", self.map, FLOW_OFFSET, litresPerMinute)
+            for channel, litres in runLitres.items():
+                if channel in self.index:
+                    struct.pack_into("<d", self.map, HEADER.size + self.index[channel] * RECORD.size +
+                                     LITRES_OFFSET, litres)
+            self.seq += 1
+            struct.pack_into("<Q", self.map, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        """
+        Unmap the file. It is left in place so readers keep
+        the last state.
+        """
+        self.map.close()
+
+
+class StatusReader():
+    # pylint: disable="invalid-name"
+    """
+    API side of the snapshot. The file is mapped on first use
+    and mapped again when the controller restarts and replaces it.
+    """
+    def __init__(self, path=STATUS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+        self.inode = None
+
+    def mapping(self):
+        """
+        Return the mapping of the current file
+        """
+        inode = os.stat(self.path).st_ino
+        with self.lock:
+            if inode != self.inode:
+                with open(self.path, "rb") as statusFile:
+                    newMap = mmap.mmap(statusFile.fileno(), 0, access=mmap.ACCESS_READ)
+                if newMap[:4] != MAGIC:
+                    newMap.close()
+                    raise OSError("Invalid status file")
+                if self.map is not None:
+                    self.map.close()
+                self.map = newMap
+                self.inode = inode
+            return self.map
+
+    def read(self):
+        """
+        Return a consistent copy of the snapshot as a dict.
+        Raises OSError if there is no snapshot to read.
+        """
+        statusMap = self.mapping()
+        for _ in range(READ_RETRIES):
+            data = statusMap[:]
+            seq = struct.unpack_from("<Q", statusMap, SEQ_OFFSET)[0]
+            _, layout, dataSeq, count, flags, updated, flowRate = HEADER.unpack_from(data)
+            if dataSeq % 2 == 0 and dataSeq == seq:
+                break
+            time.sleep(0)
+        else:
+            raise OSError("Status snapshot busy")
+        if layout != LAYOUT_VERSION:
+            raise OSError("Unsupported status layout")
+        channels = []
+        for index in range(count):
+            (channel, enabled, state, delaySeconds, nextStartTime, nextEndTime,
+             nextTransition, litres) = RECORD.unpack_from(data, HEADER.size + index * RECORD.size)
+            channels.append({"channel": channel,
+                             "enabled": enabled,
+                             "state": STATE_NAMES.get(state, "off"),
+                             "running": state == queueCmd.CHANNEL_ON,
+                             "nextStartTime": nextStartTime,
+                             "nextEndTime": nextEndTime,
+                             "nextTransition": nextTransition,
+                             "delay": delaySeconds,
+                             "litres": litres})
+        return {"version": seq // 2,
+                "updated": updated,
+                "synchronized": bool(flags & FLAG_SYNCHRONIZED),
+                "flowRate": flowRate,
+                "channels": channels}
@@ -0,0 +1,145 @@
+"""
+storage - SQLite access shared by the controller and the API server.
+The DB runs in WAL mode, so readers never block the writer and
+the two processes don't stall each other, with synchronous=NORMAL
+so a commit doesn't wait for an fsync, only checkpoints do.
+Connections are kept open and run in autocommit mode, writes are
+grouped in explicit transactions. The SQL of the hot paths is
+kept in constants so the statement cache of each connection
+reuses the prepared statements.
+"""
+import time
+import sqlite3
+import threading
+import contextlib
+
+DB_NAME = "gardenpi.sqlite"
+BUSY_TIMEOUT_S = 5
+STATEMENT_CACHE = 64
+POOL_SIZE = 4
+
+SELECT_UPDATED = ("SELECT channel,enabled,period_s,duration_s,startTimeOfDay,"
+                  "extraStartTimes,weekdays,anchor from configuration WHERE updated=1")
+CLEAR_UPDATED = "UPDATE configuration set updated=0 WHERE updated=1"
+# Rows added with the column default get a local midnight as anchor, see schedule
+SET_MISSING_ANCHORS = "UPDATE configuration set anchor=? WHERE anchor IS NULL OR anchor=0"
+SELECT_CONFIGURATION = ("SELECT channel,enabled,period_s,duration_s,startTimeOfDay,"
+                        "extraStartTimes,weekdays,anchor from configuration")
+SELECT_SETTINGS = "SELECT name, value FROM settings"
+SELECT_RELAYS = "SELECT channel, device, pin, activeLow FROM relays"
+SELECT_SENSORS = "SELECT name, source, scale, offset FROM sensors"
+INSERT_RUN = ("INSERT INTO history(channel,scheduledStart,actualStart,actualEnd,delay,litres) "
+              "VALUES(?,?,?,?,?,?)")
+ADD_DAILY_USAGE = ("INSERT INTO dailyUsage(day,channel,runs,seconds,delaySeconds,litres) "
+                   "VALUES(?,?,1,?,?,?) "
+                   "ON CONFLICT(day,channel) DO UPDATE SET runs=runs+1,"
+                   "seconds=seconds+excluded.seconds,delaySeconds=delaySeconds+excluded.delaySeconds,"
+                   "litres=litres+excluded.litres")
+MERGE_SENSOR_DATA = ("INSERT INTO sensorData(sensor,resolution,bucket,count,total,minimum,maximum) "
+                     "VALUES(?,?,?,?,?,?,?) ON CONFLICT(sensor,resolution,bucket) DO UPDATE SET "
+                     "count=count+excluded.count,total=total+excluded.total,"
+                     "minimum=min(minimum,excluded.minimum),maximum=max(maximum,excluded.maximum)")
+EXPIRE_SENSOR_DATA = "DELETE FROM sensorData WHERE sensor=? AND resolution=? AND bucket<?"
+
+
+def connect(name=DB_NAME, rows=False):
+    """
+    Open a connection with the shared settings. rows selects
+    sqlite3.Row results instead of tuples.
+    """
+    con = sqlite3.connect(name, timeout=BUSY_TIMEOUT_S, isolation_level=None,
+                          check_same_thread=False, cached_statements=STATEMENT_CACHE)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    if rows:
+        con.row_factory = sqlite3.Row
+    return con
+
+
+@contextlib.contextmanager
+def transaction(con, immediate=True):
+    """
+    Run the statements of the block in one transaction. An
+    immediate transaction takes the write lock at the start,
+    so a read followed by a write sees no other writer between.
+    """
+    con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+
+def dataVersion(con):
+    # pylint: disable="invalid-name"
+    """
+    Return a value that changes when another connection commits
+    """
+    return con.execute("PRAGMA data_version").fetchone()[0]
+
+
+class ConnectionPool():
+    # pylint: disable="invalid-name"
+    """
+    Open connections reused across requests. Up to size idle
+    connections are kept, more are opened when needed.
+    """
+    def __init__(self, name=DB_NAME, size=POOL_SIZE, rows=True):
+        self.name = name
+        self.size = size
+        self.rows = rows
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire(self):
+        """
+        Return a connection for the caller's exclusive use
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return connect(self.name, self.rows)
+
+    def release(self, con):
+        """
+        Give a connection back to the pool
+        """
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+        con.close()
+
+
+class ChangeWatcher():
+    # pylint: disable="invalid-name"
+    """
+    Detects changes to the DB made by any connection. It has a
+    connection of its own that never writes, so its data_version
+    changes on every commit, local or from another process.
+    """
+    def __init__(self, name=DB_NAME):
+        self.name = name
+        self.lock = threading.Lock()
+        self.con = None
+        self.version = None
+        self.changeTime = time.time()
+
+    def current(self):
+        """
+        Return the DB version and the time its change was first
+        seen. The version is only meaningful within this process.
+        """
+        with self.lock:
+            if self.con is None:
+                self.con = connect(self.name)
+            version = dataVersion(self.con)
+            if version != self.version:
+                if self.version is not None:
+                    self.changeTime = time.time()
+                self.version = version
+            return self.version, self.changeTime
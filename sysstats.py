@@ -0,0 +1,219 @@
+"""
+sysstats - In process system status collection for the
+status screen.
+Values are read from the kernel (ioctl and /proc) instead
+of forking shell scripts. Each value is cached with its
+own time to live and refreshed by a background thread, so
+the display never waits for them. Nothing is refreshed while
+no screen shows the values.
+"""
+import time
+import socket
+import struct
+import fcntl
+import logging
+import threading
+import subprocess
+import metrics
+
+WIFI_INTERFACE = "wlan0"
+
+SIOCGIFADDR = 0x8915
+
+# Seconds each value is kept before being refreshed
+IP_TTL_S = 10
+SSID_TTL_S = 60
+SIGNAL_TTL_S = 5
+
+
+def timeString():
+    # pylint: disable="invalid-name"
+    """
+    Current time of day for the status screen
+    """
+    return time.strftime("Time: %H:%M:%S")
+
+
+def interfaceAddress(name):
+    # pylint: disable="invalid-name"
+    """
+    Return the IPv4 address of a network interface,
+    or None if it has no address
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            res = fcntl.ioctl(sock.fileno(), SIOCGIFADDR,
+                              struct.pack("256s", name[:15].encode()))
+        except OSError:
+            return None
+    return socket.inet_ntoa(res[20:24])
+
+
+def readAddresses():
+    # pylint: disable="invalid-name"
+    """
+    Return the IPv4 addresses of all interfaces except
+    loopback, like hostname -I
+    """
+    addresses = []
+    for _, name in socket.if_nameindex():
+        if name == "lo":
+            continue
+        address = interfaceAddress(name)
+        if address is not None:
+            addresses.append(address)
+    return addresses
+
+
+def readSignal(interface=WIFI_INTERFACE):
+    # pylint: disable="invalid-name"
+    """
+    Return the signal level in dBm of a wireless interface
+    from /proc/net/wireless, or None if not associated
+    """
+    try:
+        with open("/proc/net/wireless", encoding="ascii") as wireless:
+            for line in wireless:
+                name, sep, values = line.partition(":")
+                if sep and name.strip() == interface:
+                    return int(float(values.split()[2]))
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def readSsid(interface=WIFI_INTERFACE):
+    # pylint: disable="invalid-name"
+    """
+    Return the SSID the wireless interface is associated to.
+    The SSID is not available from /proc or /sys, so this runs iw,
+    but only from the refresh thread and with a long time to live.
+    """
+    try:
+        res = subprocess.run(["iw", interface, "info"], capture_output=True,
+                             check=False, timeout=5)
+    except FileNotFoundError:
+        return None
+    for line in res.stdout.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        if line.startswith("ssid "):
+            return line[5:]
+    return None
+
+
+class StatsProvider(threading.Thread):
+    # pylint: disable="invalid-name"
+    """
+    Thread that keeps the system status values cached.
+    The get functions only return the cached strings, they
+    never block on the system.
+    """
+    def __init__(self, *args, **kwargs):
+        self.stopEvent = threading.Event()
+        self.wakeEvent = threading.Event()
+        self.active = False
+        self.values = {"ip": "IP: ", "ssid": "SSID: ", "signal": "Signal: "}
+        self.refreshers = [
+            ("ip", IP_TTL_S, self.refreshIp),
+            ("ssid", SSID_TTL_S, self.refreshSsid),
+            ("signal", SIGNAL_TTL_S, self.refreshSignal),
+        ]
+        self.expiry = {}
+        self.refreshTime = {}
+        for name, _, _ in self.refreshers:
+            self.expiry[name] = 0
+            self.refreshTime[name] = metrics.histogram(
+                "gardenpi_stats_refresh_seconds",
+                "Time to read a value shown on the status screen", {"value": name})
+        super().__init__(*args, **kwargs)
+
+    def refreshIp(self):
+        """
+        Refresh the IP address string
+        """
+        return "IP: " + " ".join(readAddresses())
+
+    def refreshSsid(self):
+        """
+        Refresh the SSID string
+        """
+        ssid = readSsid()
+        return f"SSID: {ssid if ssid is not None else ''}"
+
+    def refreshSignal(self):
+        """
+        Refresh the signal level string
+        """
+        rssi = readSignal()
+        if rssi is None:
+            return "Signal: "
+        percent = (rssi + 110) * 10 // 7
+        return f"Signal: {rssi} dBm {percent}%"
+
+    def refresh(self, currentTime):
+        """
+        Refresh every expired value. Returns the time
+        the next value expires
+        """
+        for name, ttl, refresher in self.refreshers:
+            if self.expiry[name] <= currentTime:
+                startTime = time.perf_counter()
+                try:
+                    self.values[name] = refresher()
+                except Exception:  # pylint: disable="broad-exception-caught"
+                    logging.exception("Can't refresh %s", name)
+                self.refreshTime[name].observe(time.perf_counter() - startTime)
+                self.expiry[name] = currentTime + ttl
+        return min(self.expiry.values())
+
+    def getTime(self):
+        """
+        Return the time string
+        """
+        return timeString()
+
+    def getIp(self):
+        """
+        Return the cached IP address string
+        """
+        return self.values["ip"]
+
+    def getSsid(self):
+        """
+        Return the cached SSID string
+        """
+        return self.values["ssid"]
+
+    def getSignal(self):
+        """
+        Return the cached signal level string
+        """
+        return self.values["signal"]
+
+    def setActive(self, active):
+        """
+        Start or stop refreshing the values, they are only
+        refreshed while a screen shows them. Expired values
+        are refreshed as soon as the refresh is started again.
+        """
+        if active != self.active:
+            self.active = active
+            self.wakeEvent.set()
+
+    def stop(self):
+        """
+        Stop the refresh thread
+        """
+        self.stopEvent.set()
+        self.wakeEvent.set()
+
+    def run(self):
+        logging.info("Stats thread starting")
+        while not self.stopEvent.is_set():
+            timeout = None
+            if self.active:
+                nextExpiry = self.refresh(time.monotonic())
+                timeout = max(0, nextExpiry - time.monotonic())
+            self.wakeEvent.wait(timeout)
+            self.wakeEvent.clear()
+        logging.info("Stats thread exiting")
@@ -0,0 +1,314 @@
+"""
+timeseries - Sensor samples and their rollups.
+The sampler reads the sensors from pluggable sources and keeps
+the samples in memory, in a pair of compact time and value arrays
+per sensor. The DB thread writes them in bulk every
+FLUSH_INTERVAL_S as rollups of one minute, one hour and one day:
+the count, sum, minimum and maximum of the samples of each period,
+merged with the rows already written. Raw samples never reach the
+SD card. Each resolution is kept for its own retention period, so
+a chart over a year reads a row per hour at most. Samples still
+buffered are lost if the controller crashes, a clean exit writes
+them.
+"""
+import math
+import time
+import array
+import random
+import logging
+import threading
+import clock
+import metrics
+import schedule
+import storage
+
+MINUTE = 60
+HOUR = 3600
+DAY = schedule.DAY_SECONDS
+# Seconds the rollups of each resolution are kept
+RETENTION_S = {MINUTE: 14 * DAY, HOUR: 400 * DAY, DAY: 10 * 366 * DAY}
+
+# Seconds between sensor readings, default of the sensorIntervalSeconds setting
+SAMPLE_INTERVAL_S = 10
+# Buffered samples are written when the oldest has waited this long
+FLUSH_INTERVAL_S = 300
+# Oldest samples of a sensor are dropped past this, if the DB can't be written
+MAX_BUFFERED = 8192
+
+samplesRead = metrics.counter("gardenpi_sensor_samples_total", "Sensor samples recorded")
+readErrors = metrics.counter("gardenpi_sensor_read_errors_total", "Sensor readings that failed")
+
+
+def bucketStart(timestamp, resolution):
+    # pylint: disable="invalid-name"
+    """
+    Return the start of the rollup period of a resolution
+    containing timestamp. Days start at local midnight.
+    """
+    if resolution == DAY:
+        return schedule.startOfDay(timestamp)
+    return timestamp - timestamp % resolution
+
+
+def rollups(sensor, times, values):
+    """
+    Return the rollup rows of a block of samples of a sensor as
+    (sensor, resolution, bucket, count, total, minimum, maximum)
+    """
+    minutes = {}
+    for timestamp, value in zip(times, values):
+        bucket = timestamp - timestamp % MINUTE
+        entry = minutes.get(bucket)
+        if entry is None:
+            minutes[bucket] = [1, value, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            entry[2] = min(entry[2], value)
+            entry[3] = max(entry[3], value)
+    # Hours and days are built from the minutes
+    coarser = {HOUR: {}, DAY: {}}
+    for bucket, (count, total, minimum, maximum) in minutes.items():
+        for resolution, buckets in coarser.items():
+            start = bucketStart(bucket, resolution)
+            entry = buckets.get(start)
+            if entry is None:
+                buckets[start] = [count, total, minimum, maximum]
+            else:
+                entry[0] += count
+                entry[1] += total
+                entry[2] = min(entry[2], minimum)
+                entry[3] = max(entry[3], maximum)
+    rows = [(sensor, MINUTE, bucket, *entry) for bucket, entry in minutes.items()]
+    for resolution, buckets in coarser.items():
+        rows.extend((sensor, resolution, bucket, *entry) for bucket, entry in buckets.items())
+    return rows
+
+
+class SysfsSource():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Value of a sysfs attribute times scale plus offset, such as
+    an IIO ADC channel (in_voltageN_raw) for a soil moisture
+    probe or a hwmon input for the supply voltage
+    """
+    def __init__(self, path, scale=1, offset=0):
+        self.path = path
+        self.scale = scale
+        self.offset = offset
+    def read(self):
+        with open(self.path, "rb") as attribute:
+            return float(attribute.read()) * self.scale + self.offset
+
+
+class FunctionSource():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Value returned by a function, such as the rate of the
+    flow meter
+    """
+    def __init__(self, function):
+        self.function = function
+    def read(self):
+        return self.function()
+
+
+class SimSource():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Simulated sensor following a cycle of period seconds around
+    mean, plus gaussian noise. Times come from timeSource.
+    """
+    def __init__(self, mean=0, amplitude=1, period=DAY, noise=0, timeSource=clock.now, seed=None):
+        # pylint: disable="too-many-arguments"
+        self.mean = mean
+        self.amplitude = amplitude
+        self.period = period
+        self.noise = noise
+        self.timeSource = timeSource
+        self.random = random.Random(seed)
+    def read(self):
+        phase = 2 * math.pi * self.timeSource() / self.period
+        return self.mean + self.amplitude * math.sin(phase) + self.random.gauss(0, self.noise)
+
+
+class ScaledSource():
+    # pylint: disable="invalid-name,too-few-public-methods"
+    """
+    Value of another source times scale plus offset
+    """
+    def __init__(self, source, scale=1, offset=0):
+        self.source = source
+        self.scale = scale
+        self.offset = offset
+    def read(self):
+        return self.source.read() * self.scale + self.offset
+
+
+def sensorSource(source, scale=1, offset=0, flowMeter=None):
+    # pylint: disable="invalid-name"
+    """
+    Return the source of a sensors table entry: "sysfs:<path>",
+    "flow" for the flow meter rate, or
+    "sim:<mean>:<amplitude>[:<period>[:<noise>]]".
+    The values of every source are multiplied by scale and
+    offset is added.
+    """
+    kind, _, argument = source.partition(":")
+    if kind == "sysfs":
+        return SysfsSource(argument, scale, offset)
+    if kind == "flow":
+        if flowMeter is None:
+            raise ValueError("No flow meter fitted")
+        res = FunctionSource(flowMeter.rate)
+    elif kind == "sim":
+        res = SimSource(*[float(value) for value in argument.split(":")])
+    else:
+        raise ValueError(f"Unknown sensor source {source}")
+    if (scale, offset) != (1, 0):
+        res = ScaledSource(res, scale, offset)
+    return res
+
+
+class SensorStore():
+    # pylint: disable="invalid-name"
+    """
+    Buffer of sensor samples. record() is called by the
+    sampler, flush() by the thread owning the DB connection.
+    """
+    def __init__(self, flushInterval=FLUSH_INTERVAL_S):
+        self.flushInterval = flushInterval
+        self.lock = threading.Lock()
+        self.times = {}
+        self.values = {}
+        self.oldest = None
+        self.dropped = 0
+        metrics.gauge("gardenpi_sensor_samples_dropped_total",
+                      "Sensor samples dropped as the DB couldn't be written",
+                      lambda: self.dropped, kind="counter")
+
+    def record(self, sensor, timestamp, value):
+        """
+        Buffer a sample
+        """
+        with self.lock:
+            times = self.times.get(sensor)
+            if times is None:
+                times = self.times[sensor] = array.array("d")
+                self.values[sensor] = array.array("d")
+            values = self.values[sensor]
+            if len(times) >= MAX_BUFFERED:
+                del times[0]
+                del values[0]
+                self.dropped += 1
+            times.append(timestamp)
+            values.append(value)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+    def flushDue(self):
+        """
+        Return True if the buffered samples should be written
+        """
+        with self.lock:
+            return self.oldest is not None and time.monotonic() - self.oldest >= self.flushInterval
+
+    def restore(self, times, values):
+        """
+        Put back in front the samples of a block that couldn't
+        be written, they are retried with the next one
+        """
+        with self.lock:
+            for sensor, sensorTimes in times.items():
+                sensorValues = values[sensor]
+                sensorTimes.extend(self.times.get(sensor, ()))
+                sensorValues.extend(self.values.get(sensor, ()))
+                excess = len(sensorTimes) - MAX_BUFFERED
+                if excess > 0:
+                    del sensorTimes[:excess]
+                    del sensorValues[:excess]
+                    self.dropped += excess
+                self.times[sensor] = sensorTimes
+                self.values[sensor] = sensorValues
+            self.oldest = time.monotonic()
+
+    def flush(self, con):
+        """
+        Merge the buffered samples into the rollups in one
+        transaction and expire the rollups past their retention.
+        The samples are kept if the transaction fails.
+        Returns the number of samples written.
+        """
+        with self.lock:
+            times = self.times
+            values = self.values
+            self.times = {}
+            self.values = {}
+            self.oldest = None
+        if not times:
+            return 0
+        rows = []
+        for sensor, sensorTimes in times.items():
+            rows.extend(rollups(sensor, sensorTimes, values[sensor]))
+        now = clock.now()
+        try:
+            with storage.transaction(con):
+                con.executemany(storage.MERGE_SENSOR_DATA, rows)
+                con.executemany(storage.EXPIRE_SENSOR_DATA,
+                                [(sensor, resolution, now - retention) for sensor in times
+                                 for resolution, retention in RETENTION_S.items()])
+        except Exception:
+            self.restore(times, values)
+            raise
+        samples = sum(len(sensorTimes) for sensorTimes in times.values())
+        logging.debug("Wrote %d sensor samples", samples)
+        return samples
+
+
+class SensorSampler(threading.Thread):
+    # pylint: disable="invalid-name"
+    """
+    Sensor reading thread. Every interval seconds it reads
+    the sources, a dict of sensor name: source, and records
+    their values in a SensorStore.
+    """
+    def __init__(self, store, sources, interval=SAMPLE_INTERVAL_S, *args, **kwargs):
+        # pylint: disable="keyword-arg-before-vararg"
+        self.store = store
+        self.sources = sources
+        self.interval = interval
+        self.stopping = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def step(self):
+        """
+        Read every sensor once. Returns the seconds to wait
+        until the next reading
+        """
+        now = clock.now()
+        for name, source in self.sources.items():
+            try:
+                value = source.read()
+            except (OSError, ValueError):
+                logging.debug("Can't read sensor %s", name, exc_info=True)
+                readErrors.inc()
+                continue
+            self.store.record(name, now, value)
+            samplesRead.inc()
+        return self.interval
+
+    def stop(self):
+        """
+        Make the thread exit
+        """
+        self.stopping.set()
+
+    def run(self):
+        try:
+            logging.info("Sensor thread starting")
+            while not self.stopping.wait(self.step()):
+                pass
+            logging.info("Sensor thread exiting")
+        except Exception:  # pylint: disable="broad-exception-caught"
+            # Watering goes on without the sensors
+            logging.exception("Exception on sensor thread")